@@ -5,7 +5,8 @@
 __author__ = """Konstantin Stepanov"""
 __version__ = '0.0.1b2'
 
-from . import app, db, http, error, task, chat
+from . import app, db, http, error, task, chat, metrics, deadline
 
 
-__all__ = ['app', 'db', 'http', 'error', 'task', 'chat']
+__all__ = ['app', 'db', 'http', 'error', 'task', 'chat', 'metrics',
+           'deadline']
@@ -1,10 +1,12 @@
+import time
 import asyncio
 import signal
 import logging
 from typing import Dict
 import aiozipkin as az
 from .error import PrepareError, GracefulExit
-from .tracer import Tracer, TracerTransport
+from .tracer import Tracer, TracerTransport, NOOP_TRACER
+from .metrics import Registry
 
 
 logger = logging.getLogger('aioapp')
@@ -19,10 +21,18 @@ class Component(object):
         super(Component, self).__init__()
         self.loop = None
         self.app = None
+        self.name = None
 
     async def prepare(self):
         raise NotImplementedError()
 
+    async def warmup(self):
+        """
+        Optional warm-up (opening connections, priming caches) called after
+        all components are prepared and before any of them is started
+        """
+        pass
+
     async def start(self):
         raise NotImplementedError()
 
@@ -38,6 +48,7 @@ class Application(object):
         self._stop_deps: dict = {}
         self._stopped: list = []
         self._tracer: Tracer = None
+        self._metrics: Registry = Registry()
 
     def add(self, name: str, comp: Component,
             stop_after: list = None):
@@ -47,9 +58,19 @@ class Application(object):
             raise UserWarning()
         comp.loop = self.loop
         comp.app = self
+        comp.name = name
         self._components[name] = comp
         self._stop_deps[name] = stop_after
 
+    @property
+    def tracer(self) -> Tracer:
+        """
+        Configured tracer or no-op tracer if tracing is not set up
+        """
+        if self._tracer is None:
+            return NOOP_TRACER
+        return self._tracer
+
     def __getattr__(self, item: str) -> Component:
         if item not in self._components:
             raise AttributeError
@@ -74,14 +95,39 @@ class Application(object):
                       tracer_name=None, tracer_sample_rate=1.0,
                       tracer_send_inteval=3,
                       metrics_driver=None, metrics_addr=None,
-                      metrics_name=None):
+                      metrics_name=None, metrics_aggregate=False,
+                      tracer_max_queue_spans=10000,
+                      tracer_max_queue_bytes=16 * 1024 * 1024,
+                      tracer_drop_policy='oldest',
+                      tracer_max_send_backoff=60.,
+                      tracer_tail_sampling=False, tracer_tail_window=5.,
+                      tracer_tail_latency_ms=1000.,
+                      tracer_tail_max_traces=10000,
+                      tracer_tail_max_bytes=32 * 1024 * 1024):
         endpoint = az.create_endpoint(tracer_name)
+        tail_sample_rate = None
+        if tracer_tail_sampling:
+            # every trace is recorded, tracer_sample_rate is applied to
+            # finished traces without errors or slow spans
+            tail_sample_rate = tracer_sample_rate
+            tracer_sample_rate = 1.0
         sampler = az.Sampler(sample_rate=tracer_sample_rate)
         transport = TracerTransport(self, tracer_driver, tracer_addr,
                                     metrics_driver, metrics_addr, metrics_name,
                                     send_inteval=tracer_send_inteval,
-                                    loop=self.loop)
-        self._tracer = Tracer(transport, sampler, endpoint)
+                                    loop=self.loop,
+                                    metrics_aggregate=metrics_aggregate,
+                                    max_queue_spans=tracer_max_queue_spans,
+                                    max_queue_bytes=tracer_max_queue_bytes,
+                                    drop_policy=tracer_drop_policy,
+                                    max_send_backoff=tracer_max_send_backoff,
+                                    tail_sample_rate=tail_sample_rate,
+                                    tail_window=tracer_tail_window,
+                                    tail_latency_ms=tracer_tail_latency_ms,
+                                    tail_max_traces=tracer_tail_max_traces,
+                                    tail_max_bytes=tracer_tail_max_bytes)
+        self._tracer = Tracer(transport, sampler, endpoint,
+                              tail_sampling=tracer_tail_sampling)
 
     async def _shutdown_tracer(self):
         if self._tracer:
@@ -106,6 +152,11 @@ class Application(object):
                                for comp in self._components.values()],
                              loop=self.loop)
 
+        self.log_info('Warming up...')
+        await asyncio.gather(*[self._warmup_comp(name, comp)
+                               for name, comp in self._components.items()],
+                             loop=self.loop)
+
         self.log_info('Starting...')
         await asyncio.gather(*[comp.start()
                                for comp in self._components.values()],
@@ -125,6 +176,13 @@ class Application(object):
         except GracefulExit:  # pragma: no cover
             pass
 
+    async def _warmup_comp(self, name, comp):
+        start = time.monotonic()
+        await comp.warmup()
+        duration = (time.monotonic() - start) * 1000
+        self._metrics.gauge('warmup_ms', {'component': name}).set(duration)
+        self.log_info('Component %s warmed up in %.1f ms' % (name, duration))
+
     async def run_shutdown(self):
         self.log_info('Shutting down...')
         for comp_name in self._components:
@@ -8,6 +8,8 @@ from aiotg import Bot, Chat
 import aiozipkin.span as azs
 import aiozipkin.aiohttp_helpers as azah
 from .misc import json_encode
+from .tracer import annotate_lazy
+from . import deadline
 
 
 class TelegramHandler(object):
@@ -90,17 +92,26 @@ class Telegram(Component):
                             chat_id=chat_id, text=text, **options)
 
     async def api_call(self, context_span: azs.SpanAbc, method, **params):
+        """
+        Call telegram api method. The call is cancelled when the deadline of
+        the context_span trace (see aioapp.deadline) is exceeded.
+        """
+        timeout = deadline.time_left(context_span)
         self._active_calls += 1
         try:
-            # TODO if tracer is None
             with context_span.tracer.new_child(context_span.context) as span:
                 span.name('telegram:%s' % method)
                 span.kind(azah.CLIENT)
                 span.tag('telegram.method', method)
                 if 'chat_id' in params:
                     span.tag('telegram:chat_id', params.get('chat_id'))
-                span.annotate(json_encode(params))
-                await self.bot.api_call(method, **params)
+                annotate_lazy(span, json_encode, params)
+                if timeout is None:
+                    await self.bot.api_call(method, **params)
+                else:
+                    await asyncio.wait_for(self.bot.api_call(method,
+                                                             **params),
+                                           timeout, loop=self.loop)
         finally:
             self._active_calls -= 1
             if self._stopping and self._active_calls == 0:
@@ -136,37 +147,9 @@ class Telegram(Component):
         async def wrap(func, chat, match):
             self._active_msgs += 1
             try:
-                span = self.app._tracer.new_trace(sampled=True,
-                                                  debug=False)
+                span = self.app.tracer.new_trace(sampled=True, debug=False)
                 with span:
-                    span.name('telegram:in')
-                    span.kind(azah.SERVER)
-                    span.tag('telegram:date',
-                             chat.message.get('date'))
-                    span.tag('telegram:message_id',
-                             chat.message.get('message_id'))
-                    span.tag('telegram:from_username',
-                             chat.message.get('from', {}).get('username'))
-                    span.tag('telegram:from_last_name',
-                             chat.message.get('from', {}).get('last_name'))
-                    span.tag('telegram:from_first_name',
-                             chat.message.get('from', {}).get('first_name'))
-                    span.tag('telegram:from_id',
-                             chat.message.get('from', {}).get('id'))
-                    span.tag('telegram:from_is_bot',
-                             chat.message.get('from', {}).get('is_bot'))
-                    span.tag('telegram:from_language_code',
-                             chat.message.get('from', {}).get('language_code'))
-                    span.tag('telegram:chat_username',
-                             chat.message.get('chat', {}).get('username'))
-                    span.tag('telegram:chat_last_name',
-                             chat.message.get('chat', {}).get('last_name'))
-                    span.tag('telegram:chat_first_name',
-                             chat.message.get('chat', {}).get('first_name'))
-                    span.tag('telegram:chat_id',
-                             chat.message.get('chat', {}).get('id'))
-                    span.tag('telegram:chat_type',
-                             chat.message.get('chat', {}).get('private'))
+                    _tag_message(span, chat.message)
                     await func(span, TelegramChat(chat, self), match)
             finally:
                 self._active_msgs -= 1
@@ -178,6 +161,26 @@ class Telegram(Component):
         return pt
 
 
+def _tag_message(span: azs.SpanAbc, message: dict) -> None:
+    sender = message.get('from', {})
+    chat = message.get('chat', {})
+    span.name('telegram:in')
+    span.kind(azah.SERVER)
+    span.tag('telegram:date', message.get('date'))
+    span.tag('telegram:message_id', message.get('message_id'))
+    span.tag('telegram:from_username', sender.get('username'))
+    span.tag('telegram:from_last_name', sender.get('last_name'))
+    span.tag('telegram:from_first_name', sender.get('first_name'))
+    span.tag('telegram:from_id', sender.get('id'))
+    span.tag('telegram:from_is_bot', sender.get('is_bot'))
+    span.tag('telegram:from_language_code', sender.get('language_code'))
+    span.tag('telegram:chat_username', chat.get('username'))
+    span.tag('telegram:chat_last_name', chat.get('last_name'))
+    span.tag('telegram:chat_first_name', chat.get('first_name'))
+    span.tag('telegram:chat_id', chat.get('id'))
+    span.tag('telegram:chat_type', chat.get('private'))
+
+
 class TelegramChat:
     def __init__(self, chat: Chat, bot: Telegram) -> None:
         self._chat = chat
@@ -1,19 +1,485 @@
-import json
+import os
+import sys
+import time
+import bisect
+import hashlib
+import random
+import weakref
 import asyncio
+from collections import OrderedDict, deque
+from functools import partial
+from typing import (Optional, Iterable, AsyncIterable, Sequence, List,
+                    Dict, Set, Tuple, Any, Callable)
 import asyncpg
 import asyncpg.pool
+import asyncpg.exceptions
 import aiozipkin as az
 import aiozipkin.span as azs  # noqa
 from .app import Component
 from .error import PrepareError
-from .misc import mask_url_pwd
+from .misc import mask_url_pwd, json_dumps_bytes, json_loads
+from .tracer import annotate_lazy
+from . import deadline
+
+try:
+    import fcntl
+except ImportError:  # not POSIX, PoolBudget is not available
+    fcntl = None
+
+
+REPLICA_LAG_QUERY = '''
+SELECT CASE
+    WHEN NOT pg_is_in_recovery()
+        OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE COALESCE(
+        EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+END
+'''
+
+
+class JsonTypeCodec:
+    """
+    Binary json/jsonb codec. Values are decoded directly from the received
+    buffer with the fastest available JSON backend (see misc.json_loads).
+    With raw=True values are not decoded at all and are returned as JSON
+    bytes-like objects, e.g. to pass them to a response body as is.
+    Bytes-like values are sent as already encoded JSON. Values JSON can't
+    serialize raise TypeError.
+    """
+
+    def __init__(self, raw: bool = False,
+                 dumps=partial(json_dumps_bytes, default=None),
+                 loads=json_loads) -> None:
+        """
+        :param dumps: callable(value) -> bytes
+        :param loads: callable(bytes-like) -> value
+        """
+        self.raw = raw
+        self.dumps = dumps
+        self.loads = loads
+
+    def encode_json(self, value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return value
+        return self.dumps(value)
+
+    def decode_json(self, value):
+        if self.raw:
+            return value
+        return self.loads(value)
+
+    def encode_jsonb(self, value):
+        # jsonb binary format is version number followed by JSON text
+        return b'\x01' + self.encode_json(value)
+
+    def decode_jsonb(self, value):
+        view = memoryview(value)[1:]
+        if self.raw:
+            return view
+        return self.loads(view)
+
+
+CONN_LIFETIME_BUCKETS_S = (1, 10, 60, 300, 900, 1800, 3600, 7200, 86400)
+CONN_QUERIES_BUCKETS = (1, 10, 100, 1000, 5000, 10000, 50000, 100000)
+
+
+class QueryStats:
+    """
+    Per query id latency histograms and error counters (kept in the app
+    metrics registry) and log of recent slow queries
+    """
+
+    def __init__(self, db: 'PgDb', slow_threshold: float, args_rate: float,
+                 explain_rate: float, log_size: int) -> None:
+        self._db = db
+        self.slow_threshold = slow_threshold
+        self.args_rate = args_rate
+        self.explain_rate = explain_rate
+        self.slow: deque = deque(maxlen=log_size)
+        self._metrics: dict = {}
+
+    def _get_metrics(self, id: str):
+        metrics = self._metrics.get(id)
+        if metrics is None:
+            tags = {'db': self._db.name, 'id': id}
+            registry = self._db.app._metrics
+            metrics = (registry.histogram('db_query_ms', tags),
+                       registry.counter('db_query_errors', tags))
+            self._metrics[id] = metrics
+        return metrics
+
+    def observe(self, id: str, args, duration_ms: float,
+                error: bool) -> Optional[dict]:
+        """
+        :return: slow query log entry if query was slow
+        """
+        hist, errors = self._get_metrics(id)
+        hist.observe(duration_ms)
+        if error:
+            errors.inc()
+        if duration_ms < self.slow_threshold:
+            return None
+        entry = {
+            'id': id,
+            'duration_ms': duration_ms,
+            'time': time.time(),
+            'error': error,
+        }
+        if args and random.random() < self.args_rate:  # nosec
+            entry['args'] = repr(args)[:1000]
+        self.slow.append(entry)
+        self._db.app.log_warn('Slow query %s: %.1f ms%s'
+                              '' % (id, duration_ms,
+                                    ', args: %s' % entry['args']
+                                    if 'args' in entry else ''))
+        return entry
+
+    def should_explain(self) -> bool:
+        return self.explain_rate > 0 and \
+            random.random() < self.explain_rate  # nosec
+
+    def dump(self) -> dict:
+        queries = {}
+        for id, (hist, errors) in self._metrics.items():
+            queries[id] = {
+                'count': hist.count,
+                'errors': errors.value,
+                'sum_ms': hist.sum,
+                'p50_ms': hist.quantile(.5),
+                'p95_ms': hist.quantile(.95),
+                'p99_ms': hist.quantile(.99),
+            }
+        return {'queries': queries, 'slow': list(self.slow)}
+
+
+class QueryTrace:
+    """
+    Span of a single query (or batch) which also records query statistics.
+    Query duration excludes time between pause() and resume(). GeneratorExit
+    (a consumer stopped iterating over results) is not an error.
+    """
+
+    def __init__(self, conn: 'Connection', context_span: azs.SpanAbc,
+                 id: str, query: str, args, explain: bool = False) -> None:
+        self._conn = conn
+        self._explain = explain
+        self._id = id
+        self._query = query
+        self._args = args
+        self._start: float = None
+        self._elapsed = 0.
+        self.span = context_span.tracer.new_child(context_span.context)
+        self.span.kind(az.CLIENT)
+        self.span.name("db:%s" % id)
+        self.span.remote_endpoint("postgres")
+
+    def __enter__(self) -> azs.SpanAbc:
+        self._start = time.monotonic()
+        return self.span.__enter__()
+
+    def pause(self) -> None:
+        self._elapsed += time.monotonic() - self._start
+        self._start = None
+
+    def resume(self) -> None:
+        self._start = time.monotonic()
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._start is not None:
+            self.pause()
+        duration = self._elapsed * 1000
+        if exc_type is not None and issubclass(exc_type, GeneratorExit):
+            exc_type = exc = tb = None
+        stats = self._conn._db._query_stats
+        entry = stats.observe(self._id, self._args, duration,
+                              exc_type is not None)
+        if entry is not None:
+            self.span.tag('db.slow', 'true')
+            if exc_type is None and self._explain and \
+                    stats.should_explain():
+                self._conn._explain_entry = (entry, self._query, self._args)
+        return self.span.__exit__(exc_type, exc, tb)
+
+
+class ConnStats:
+    __slots__ = ('created', 'queries')
+
+    def __init__(self) -> None:
+        self.created = time.monotonic()
+        self.queries = 0
+
+
+class PoolStats:
+    """
+    Always-on pool metrics: acquire wait histogram (ms), pool size, idle,
+    in-use connections and acquire waiters
+    """
+
+    def __init__(self, metrics, tags: dict) -> None:
+        self.acquire_ms = metrics.histogram('db_pool_acquire_ms', tags)
+        self.waiters = metrics.gauge('db_pool_waiters', tags)
+        self.in_use = metrics.gauge('db_pool_in_use', tags)
+        self.size = metrics.gauge('db_pool_size', tags)
+        self.idle = metrics.gauge('db_pool_idle', tags)
+
+    def collect(self, pool) -> None:
+        if pool is None:
+            return
+        size = sum(1 for holder in getattr(pool, '_holders', ())
+                   if getattr(holder, '_con', None) is not None)
+        self.size.set(size)
+        self.idle.set(max(0, size - self.in_use.value))
+
+
+class PoolSizer:
+    """
+    Adjustable limit of connections used at once from the pool (the pool
+    itself is created with pool_max_size connections at most). Collects
+    acquire wait and peak usage per resize interval.
+    """
+
+    def __init__(self, loop, min_size: int, max_size: int,
+                 target_ms: float, idle_intervals: int) -> None:
+        self._loop = loop
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_ms = target_ms
+        self.idle_intervals = idle_intervals
+        self.limit = min_size
+        self.in_use = 0
+        self._waiters: deque = deque()
+        self._peak = 0
+        self._wait_sum = 0.
+        self._wait_count = 0
+        self._idle = 0
+
+    async def acquire(self, timeout: float = None):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+        else:
+            fut = asyncio.Future(loop=self._loop)
+            self._waiters.append(fut)
+            try:
+                await asyncio.wait_for(fut, timeout, loop=self._loop)
+            except BaseException:
+                if fut.done() and not fut.cancelled():
+                    # permit was handed over right before cancellation
+                    self.release()
+                elif fut in self._waiters:
+                    self._waiters.remove(fut)
+                raise
+        self._peak = max(self._peak, self.in_use)
+
+    def release(self):
+        self.in_use -= 1
+        self._wake()
+
+    def _wake(self):
+        while self._waiters and self.in_use < self.limit:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                self.in_use += 1
+                fut.set_result(None)
+
+    def observe_wait(self, wait_ms: float):
+        self._wait_sum += wait_ms
+        self._wait_count += 1
+
+    def resize(self, limit: int):
+        self.limit = limit
+        self._wake()
+
+    def decide(self) -> Tuple[int, str]:
+        """
+        New limit based on the statistics of the past interval
+
+        :return: (limit, reason)
+        """
+        avg_wait = (self._wait_sum / self._wait_count
+                    if self._wait_count else 0.)
+        peak = max(self._peak, self.in_use)
+        queued = len(self._waiters)
+        self._wait_sum = 0.
+        self._wait_count = 0
+        self._peak = self.in_use
+        step = max(1, self.limit // 4)
+        if (avg_wait > self.target_ms or queued) and \
+                self.limit < self.max_size:
+            self._idle = 0
+            return (min(self.max_size, self.limit + step),
+                    'acquire wait %.1f ms, %d queued' % (avg_wait, queued))
+        if peak <= self.limit - step and self.limit > self.min_size:
+            self._idle += 1
+            if self._idle >= self.idle_intervals:
+                self._idle = 0
+                return (max(self.min_size, peak, self.limit - step),
+                        'at most %d connections used for %d intervals'
+                        '' % (peak, self.idle_intervals))
+        else:
+            self._idle = 0
+        return self.limit, ''
+
+
+class PoolBudget:
+    """
+    Connection budget shared by processes on the host through a lock file.
+    Every process records the size of its pools in the file and a pool grows
+    only while the total fits into the budget. Records of processes that
+    are no longer running are discarded.
+    """
+
+    def __init__(self, path: str, total: int) -> None:
+        if fcntl is None:
+            raise UserWarning('PoolBudget requires fcntl (POSIX)')
+        self.path = path
+        self.total = total
+
+    def _update(self, key: str, size: Optional[int]) -> int:
+        with open(self.path, 'a+b') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                data = f.read()
+                try:
+                    sizes = json_loads(data) if data else {}
+                except ValueError:
+                    sizes = {}
+                sizes = {k: v for k, v in sizes.items()
+                         if k != key and _pid_alive(int(k.split(':')[0]))}
+                if size is not None:
+                    size = min(size, max(0, self.total - sum(sizes.values())))
+                    sizes[key] = size
+                f.seek(0)
+                f.truncate()
+                f.write(json_dumps_bytes(sizes))
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return size
+
+    def reserve(self, key: str, size: int) -> int:
+        """
+        Reserve size connections for key (replacing its previous reservation).
+        Blocks on the lock file, run it in the executor.
+
+        :return: granted number of connections, size or less
+        """
+        return self._update(key, size)
+
+    def release(self, key: str):
+        self._update(key, None)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class Replica:
+    """
+    Read replica pool with load balancing statistics
+    """
+
+    def __init__(self, name: str, dsn: str,
+                 latency_decay: float = 0.2) -> None:
+        self.name = name
+        self.dsn = dsn
+        self.pool = None  # type: asyncpg.pool.Pool
+        self.stats: PoolStats = None
+        self.latency_decay = latency_decay
+        self.latency = 0.  # moving average of query duration, ms
+        self.in_flight = 0
+        self.lag = 0.  # replication lag, seconds
+        self.excluded = True  # until connected and checked
+
+    @property
+    def masked_dsn(self):
+        return mask_url_pwd(self.dsn)
+
+    @property
+    def score(self) -> float:
+        return (self.latency + 1.) * (self.in_flight + 1)
+
+    def observe(self, duration_ms: float) -> None:
+        self.latency += self.latency_decay * (duration_ms - self.latency)
 
 
 class PgDb(Component):
     def __init__(self, dsn, pool_min_size=10, pool_max_size=10,
                  pool_max_queries=50000,
                  pool_max_inactive_connection_lifetime=300.0,
-                 connect_max_attempts=10, connect_retry_delay=1.0) -> None:
+                 connect_max_attempts=10, connect_retry_delay=1.0,
+                 warmup_connections=0, warmup_queries=None,
+                 statement_cache_size=100,
+                 prepare_registered_queries=True,
+                 replica_dsns: List[str] = None,
+                 replica_max_lag: float = 10.,
+                 replica_check_interval: float = 5.,
+                 result_cache_max_size: int = 0,
+                 json_codec: 'JsonTypeCodec' = None,
+                 slow_query_threshold: float = 1000.,
+                 slow_query_args_rate: float = 1.,
+                 slow_query_explain_rate: float = 0.,
+                 slow_query_log_size: int = 100,
+                 pool_adaptive: bool = False,
+                 pool_acquire_target_ms: float = 10.,
+                 pool_resize_interval: float = 5.,
+                 pool_idle_intervals: int = 6,
+                 pool_budget: 'PoolBudget' = None,
+                 listen_check_interval: float = 5.) -> None:
+        """
+        :param warmup_connections: number of pool connections opened during
+            application warm-up
+        :param warmup_queries: queries prepared on every warmed up
+            connection, so their statements are cached before first use.
+            With statement_cache_size > 0 only queries registered with
+            register_query() stay cached, under their query id
+        :param statement_cache_size: size of per-connection LRU cache of
+            prepared statements keyed by query id (0 disables it and uses
+            asyncpg's own cache keyed by query text instead). asyncpg's
+            cache is disabled while this one is used, so statements evicted
+            from it are closed on the server. execute() with a cached
+            statement receives the rows the statement returns (e.g. with
+            UPDATE ... RETURNING) before discarding them, use query_all()
+            for such statements
+        :param prepare_registered_queries: eagerly prepare queries added
+            with register_query() on every new connection
+        :param replica_dsns: read replicas, query_one/query_all/query_iter
+            and fetch_many are routed to the replica with the best observed
+            latency and in-flight count (use_replica=False opts out)
+        :param replica_max_lag: replicas lagging more than this number of
+            seconds are excluded from routing
+        :param replica_check_interval: replication lag check interval
+        :param result_cache_max_size: approximate memory limit (bytes) of
+            query_one/query_all result cache, 0 disables it. Results are
+            cached only for query ids registered with cache_query()
+        :param json_codec: codec of json and jsonb values
+        :param slow_query_threshold: queries running longer (ms) are logged
+            as slow and kept in the slow query log, see query_stats()
+        :param slow_query_args_rate: fraction of slow queries logged with
+            their arguments
+        :param slow_query_explain_rate: fraction of slow query_one/query_all
+            executions re-run with EXPLAIN (ANALYZE, BUFFERS) in a rolled
+            back transaction to capture the plan
+        :param slow_query_log_size: number of recent slow queries kept
+        :param pool_adaptive: size the primary pool between pool_min_size
+            and pool_max_size by load instead of using all pool_max_size
+            connections. Every pool_resize_interval seconds the limit grows
+            if average acquire wait exceeds pool_acquire_target_ms and
+            shrinks after pool_idle_intervals intervals with unused
+            connections. Idle connections above the limit are closed every
+            pool_resize_interval.
+        :param pool_budget: connection budget shared with other processes,
+            the adaptive pool does not grow beyond its share. Connections
+            in use when the pool shrinks are closed after release, at the
+            next resize interval.
+        :param listen_check_interval: health check interval of the
+            dedicated LISTEN connection, see listen()
+        """
         super(PgDb, self).__init__()
         self.dsn = dsn
         self.pool_min_size = pool_min_size
@@ -23,6 +489,42 @@ class PgDb(Component):
             pool_max_inactive_connection_lifetime
         self.connect_max_attempts = connect_max_attempts
         self.connect_retry_delay = connect_retry_delay
+        self.warmup_connections = warmup_connections
+        self.warmup_queries = warmup_queries or []
+        self.statement_cache_size = statement_cache_size
+        self.prepare_registered_queries = prepare_registered_queries
+        self._queries: dict = {}
+        self._stmt_caches: weakref.WeakKeyDictionary = \
+            weakref.WeakKeyDictionary()
+        self._stmt_metrics: dict = {}
+        self.replica_max_lag = replica_max_lag
+        self.replica_check_interval = replica_check_interval
+        self._replicas = [Replica('replica%d' % i, dsn)
+                          for i, dsn in enumerate(replica_dsns or [])]
+        self._replica_task: asyncio.Future = None
+        self._result_cache = (ResultCache(result_cache_max_size)
+                              if result_cache_max_size > 0 else None)
+        self._result_policies: Dict[str, Tuple[float, tuple]] = {}
+        self._result_metrics: dict = {}
+        self.json_codec = json_codec or JsonTypeCodec()
+        self._conn_stats: weakref.WeakKeyDictionary = \
+            weakref.WeakKeyDictionary()
+        self._pool_stats: PoolStats = None
+        self._query_stats = QueryStats(self, slow_query_threshold,
+                                       slow_query_args_rate,
+                                       slow_query_explain_rate,
+                                       slow_query_log_size)
+        self.pool_adaptive = pool_adaptive
+        self.pool_acquire_target_ms = pool_acquire_target_ms
+        self.pool_resize_interval = pool_resize_interval
+        self.pool_idle_intervals = pool_idle_intervals
+        self.pool_budget = pool_budget
+        self._pool_sizer: PoolSizer = None
+        self._pool_sizer_task: asyncio.Future = None
+        self._budget_exhausted = False
+        self.listen_check_interval = listen_check_interval
+        self._listener: Listener = None
+        self._row_mappers: Dict[tuple, Callable] = {}
         self._pool = None  # type: asyncpg.pool.Pool
 
     @property
@@ -34,108 +536,1062 @@ class PgDb(Component):
         return mask_url_pwd(self.dsn)
 
     async def _connect(self):
-        self._pool = await asyncpg.create_pool(
-            dsn=self.dsn,
+        self._pool = await self._create_pool(self.dsn)
+
+    async def _create_pool(self, dsn):
+        kwargs = {}
+        if self.statement_cache_size > 0:
+            # statements are cached by StatementCache only, otherwise
+            # asyncpg keeps statements evicted from it prepared
+            kwargs['statement_cache_size'] = 0
+        return await asyncpg.create_pool(
+            dsn=dsn,
             max_size=self.pool_max_size,
             min_size=self.pool_min_size,
             max_queries=self.pool_max_queries,
             max_inactive_connection_lifetime=(
                 self.pool_max_inactive_connection_lifetime),
-            init=PgDb._conn_init,
-            loop=self.loop
+            init=self._conn_init,
+            loop=self.loop,
+            **kwargs
         )
 
-    @staticmethod
-    async def _conn_init(conn):
-        def _json_encoder(value):
-            return json.dumps(value)
+    def register_query(self, id: str, query: str) -> None:
+        """
+        Register query to be prepared on every new connection
+        """
+        self._queries[id] = query
 
-        def _json_decoder(value):
-            return json.loads(value)
+    def cache_query(self, id: str, ttl: float, tags: Sequence[str] = ()):
+        """
+        Cache results of query_one/query_all calls with this query id by
+        (id, args) for ttl seconds. Cached results are dropped by
+        invalidate() with any of the tags (usually names of the tables the
+        query reads), e.g. by execute(..., invalidate=['table']).
+        """
+        self._result_policies[id] = (ttl, tuple(tags))
 
-        await conn.set_type_codec(
-            'json', encoder=_json_encoder, decoder=_json_decoder,
-            schema='pg_catalog'
-        )
+    def invalidate(self, *tags: str) -> int:
+        """
+        Drop cached results tagged with any of the tags
+
+        :return: number of dropped results
+        """
+        if self._result_cache is None:
+            return 0
+        return self._result_cache.invalidate(tags)
+
+    def _result_counters(self, id: str):
+        counters = self._result_metrics.get(id)
+        if counters is None:
+            tags = {'id': id}
+            counters = (
+                self.app._metrics.counter('db_result_cache_hits', tags),
+                self.app._metrics.counter('db_result_cache_misses', tags),
+            )
+            self._result_metrics[id] = counters
+        return counters
+
+    def query_stats(self) -> dict:
+        """
+        Per query id latency statistics and recent slow queries
+        """
+        return self._query_stats.dump()
+
+    def _stmt_cache(self, conn) -> Optional['StatementCache']:
+        if self.statement_cache_size <= 0:
+            return None
+        conn = _raw_conn(conn)
+        cache = self._stmt_caches.get(conn)
+        if cache is None:
+            cache = StatementCache(self, self.statement_cache_size)
+            self._stmt_caches[conn] = cache
+        return cache
 
-        def _jsonb_encoder(value):
-            return b'\x01' + json.dumps(value).encode('utf-8')
+    def _stmt_counters(self, id: str):
+        counters = self._stmt_metrics.get(id)
+        if counters is None:
+            tags = {'id': id}
+            counters = (
+                self.app._metrics.counter('db_stmt_cache_hits', tags),
+                self.app._metrics.counter('db_stmt_cache_misses', tags),
+            )
+            self._stmt_metrics[id] = counters
+        return counters
 
-        def _jsonb_decoder(value):
-            return json.loads(value[1:].decode('utf-8'))
+    def _init_metrics(self):
+        metrics = self.app._metrics
+        tags = {'db': self.name}
+        self._pool_stats = PoolStats(metrics, dict(tags, pool='primary'))
+        for replica in self._replicas:
+            replica.stats = PoolStats(metrics, dict(tags, pool=replica.name))
+        self._conn_lifetime = metrics.histogram('db_conn_lifetime_s', tags,
+                                                CONN_LIFETIME_BUCKETS_S)
+        self._conn_queries = metrics.histogram('db_conn_queries', tags,
+                                               CONN_QUERIES_BUCKETS)
+        metrics.add_collector(self._collect_metrics)
 
+    def _collect_metrics(self):
+        self._pool_stats.collect(self._pool)
+        for replica in self._replicas:
+            replica.stats.collect(replica.pool)
+
+    def _conn_closed(self, stats: ConnStats):
+        self._conn_lifetime.observe(time.monotonic() - stats.created)
+        self._conn_queries.observe(stats.queries)
+
+    async def _conn_init(self, conn):
+        stats = ConnStats()
+        self._conn_stats[conn] = stats
+        # called when connection is closed and garbage collected
+        weakref.finalize(conn, self._conn_closed, stats)
+
+        codec = self.json_codec
+        await conn.set_type_codec(
+            'json',
+            encoder=codec.encode_json,
+            decoder=codec.decode_json,
+            schema='pg_catalog',
+            format='binary',
+        )
         # Example was got from https://github.com/MagicStack/asyncpg/issues/140
         await conn.set_type_codec(
             'jsonb',
-            encoder=_jsonb_encoder,
-            decoder=_jsonb_decoder,
+            encoder=codec.encode_jsonb,
+            decoder=codec.decode_jsonb,
             schema='pg_catalog',
             format='binary',
         )
 
+        if self.prepare_registered_queries and self._queries:
+            cache = self._stmt_cache(conn)
+            if cache is not None:
+                for id, query in self._queries.items():
+                    try:
+                        await cache.prepare(conn, id, query)
+                    except asyncpg.PostgresError as e:
+                        self.app.log_warn('Could not prepare query %s: %s'
+                                          '' % (id, e))
+
     async def prepare(self):
+        self._init_metrics()
+        if self.pool_adaptive:
+            self._pool_sizer = PoolSizer(self.loop, self.pool_min_size,
+                                         self.pool_max_size,
+                                         self.pool_acquire_target_ms,
+                                         self.pool_idle_intervals)
         self.app.log_info("Connecting to %s" % self._masked_dsn)
         for i in range(self.connect_max_attempts):
             try:
                 await self._connect()
                 self.app.log_info("Connected to %s" % self._masked_dsn)
-                return
+                break
             except Exception as e:
                 self.app.log_err(str(e))
                 await asyncio.sleep(self.connect_retry_delay)
-        raise PrepareError("Could not connect to %s" % self._masked_dsn)
+        else:
+            raise PrepareError("Could not connect to %s" % self._masked_dsn)
+        # replicas are optional, unavailable ones are retried by the lag
+        # checker and reads go to the primary meanwhile
+        await asyncio.gather(*[self._check_replica(replica)
+                               for replica in self._replicas],
+                             loop=self.loop)
+
+    async def _check_replica(self, replica: Replica):
+        try:
+            if replica.pool is None:
+                self.app.log_info("Connecting to replica %s"
+                                  "" % replica.masked_dsn)
+                replica.pool = await self._create_pool(replica.dsn)
+            async with replica.pool.acquire() as conn:
+                replica.lag = float(await conn.fetchval(REPLICA_LAG_QUERY))
+            excluded = replica.lag > self.replica_max_lag
+            if excluded:
+                self.app.log_warn('Replica %s lags %.1f s, excluded'
+                                  '' % (replica.masked_dsn, replica.lag))
+        except Exception as e:
+            self.app.log_err('Replica %s check failed: %s'
+                             '' % (replica.masked_dsn, e))
+            excluded = True
+        if replica.excluded and not excluded:
+            self.app.log_info('Replica %s is available' % replica.masked_dsn)
+        replica.excluded = excluded
+
+    async def _replica_checker(self):
+        while True:
+            await asyncio.sleep(self.replica_check_interval, loop=self.loop)
+            await asyncio.gather(*[self._check_replica(replica)
+                                   for replica in self._replicas],
+                                 loop=self.loop)
+
+    def _choose_replica(self) -> Optional[Replica]:
+        best = None
+        for replica in self._replicas:
+            if replica.excluded:
+                continue
+            if best is None or replica.score < best.score:
+                best = replica
+        return best
+
+    async def warmup(self):
+        count = min(self.warmup_connections, self.pool_max_size)
+        if count <= 0:
+            return
+        res = await asyncio.gather(*[self._pool.acquire()
+                                     for _ in range(count)],
+                                   loop=self.loop, return_exceptions=True)
+        conns = [conn for conn in res if not isinstance(conn, Exception)]
+        try:
+            for err in res:
+                if isinstance(err, Exception):
+                    self.app.log_warn('Could not open warm-up connection to '
+                                      '%s: %s' % (self._masked_dsn, err))
+            await asyncio.gather(*[self._prime_conn(conn) for conn in conns],
+                                 loop=self.loop)
+        finally:
+            for conn in conns:
+                await self._pool.release(conn)
+        self.app.log_info('Warmed up %d connections to %s'
+                          '' % (len(conns), self._masked_dsn))
+
+    async def _prime_conn(self, conn):
+        cache = self._stmt_cache(conn)
+        ids = {query: id for id, query in self._queries.items()}
+        for query in self.warmup_queries:
+            if cache is not None and query in ids:
+                await cache.prepare(conn, ids[query], query)
+            else:
+                await conn.prepare(query)
+
+    def _budget_key(self) -> str:
+        return '%d:%s' % (os.getpid(), self.name)
+
+    async def _reserve_budget(self, limit: int) -> int:
+        if self.pool_budget is None:
+            return limit
+        # flock and file I/O must not block the loop
+        granted = await self.loop.run_in_executor(
+            None, self.pool_budget.reserve, self._budget_key(), limit)
+        # pool_min_size connections are always allowed
+        return max(self._pool_sizer.min_size, granted)
+
+    async def _pool_resizer(self):
+        sizer = self._pool_sizer
+        while True:
+            await asyncio.sleep(self.pool_resize_interval, loop=self.loop)
+            # connections which were in use at the last shrink
+            self._close_idle_connections(sizer.limit)
+            limit, reason = sizer.decide()
+            if limit == sizer.limit:
+                self._budget_exhausted = False
+                continue
+            granted = await self._reserve_budget(limit)
+            if granted == sizer.limit:
+                if not self._budget_exhausted:
+                    self._budget_exhausted = True
+                    self.app.log_warn('Pool of %s can not grow: connection '
+                                      'budget of %d is exhausted'
+                                      '' % (self._masked_dsn,
+                                            self.pool_budget.total))
+                continue
+            self._budget_exhausted = False
+            self.app.log_info('Pool of %s resized %d -> %d: %s'
+                              '' % (self._masked_dsn, sizer.limit, granted,
+                                    reason))
+            sizer.resize(granted)
+            self._close_idle_connections(granted)
+
+    def _close_idle_connections(self, limit: int) -> int:
+        """
+        Close least recently used idle connections of the primary pool
+        while it holds more than limit open connections
+
+        :return: number of closed connections
+        """
+        holders = getattr(self._pool, '_holders', ())
+        opened = sum(1 for holder in holders
+                     if getattr(holder, '_con', None) is not None)
+        closed = 0
+        # the pool hands out idle connections LIFO, the bottom of its queue
+        # is used least recently
+        idle = getattr(getattr(self._pool, '_queue', None), '_queue', ())
+        for holder in list(idle):
+            if opened <= limit:
+                break
+            if getattr(holder, '_con', None) is not None:
+                holder.terminate()
+                opened -= 1
+                closed += 1
+        return closed
 
     async def start(self):
-        pass
+        if self._replicas:
+            self._replica_task = asyncio.ensure_future(
+                self._replica_checker(), loop=self.loop)
+        if self._pool_sizer is not None:
+            self._pool_sizer.resize(
+                await self._reserve_budget(self._pool_sizer.limit))
+            self._pool_sizer_task = asyncio.ensure_future(
+                self._pool_resizer(), loop=self.loop)
 
     async def stop(self):
+        if self._listener is not None:
+            await self._listener.close()
+        if self._replica_task:
+            self._replica_task.cancel()
+        if self._pool_sizer_task:
+            self._pool_sizer_task.cancel()
+        if self.pool_budget is not None and self._pool_sizer is not None:
+            await self.loop.run_in_executor(None, self.pool_budget.release,
+                                            self._budget_key())
+        for replica in self._replicas:
+            if replica.pool:
+                self.app.log_info("Disconnecting from %s"
+                                  "" % replica.masked_dsn)
+                await replica.pool.close()
         self.app.log_info("Disconnecting from %s" % self._masked_dsn)
         if self.pool:
             await self.pool.close()
 
+    async def listen(self, channel: str, callback,
+                     debounce: float = 0.) -> 'Subscription':
+        """
+        Subscribe to NOTIFY on channel. Notifications are received on a
+        dedicated connection (reconnected automatically) and callback is
+        called on the loop as callback(channel, payloads). Notifications
+        arriving within debounce seconds are passed in a single call.
+        After reconnect every callback is called with empty payloads, as
+        notifications may have been missed. Callback may be a coroutine
+        function.
+        """
+        if self._listener is None:
+            self._listener = Listener(self, self.listen_check_interval)
+        return await self._listener.listen(channel, callback, debounce)
+
+    async def unlisten(self, subscription: 'Subscription') -> None:
+        if self._listener is not None:
+            await self._listener.unlisten(subscription)
+
+    async def invalidate_on_notify(self, channel: str, *tags: str,
+                                   debounce: float = 0.) -> 'Subscription':
+        """
+        Drop cached results (see cache_query()) tagged with tags on NOTIFY
+        on channel, or with notification payloads if no tags are given.
+        After reconnect all the tags are dropped (or the whole cache, if no
+        tags are given).
+        """
+        def callback(channel, payloads):
+            if tags:
+                self.invalidate(*tags)
+            elif payloads:
+                self.invalidate(*payloads)
+            elif self._result_cache is not None:
+                self._result_cache.clear()
+
+        return await self.listen(channel, callback, debounce)
+
     def connection(self, context_span):
         return ConnectionContextManager(self, context_span)
 
+    def read_connection(self, context_span, use_replica=True):
+        """
+        Connection to the best available replica, or to the primary if
+        there is none or use_replica is False
+        """
+        replica = self._choose_replica() if use_replica else None
+        return ConnectionContextManager(self, context_span, replica)
+
     async def query_one(self, context_span: azs.SpanAbc, id: str, query: str,
-                        *args, timeout: float = None):
-        async with self.connection(context_span) as conn:
-            return await conn.query_one(context_span, id, query, *args,
-                                        timeout=timeout)
+                        *args, timeout: float = None,
+                        use_replica: bool = True, row_class: type = None):
+        """
+        :param row_class: namedtuple or class with __slots__ the record is
+            mapped to, see Connection.query_one
+        """
+        res = await self._query('query_one', context_span, id, query, args,
+                                timeout, use_replica)
+        if row_class is not None and res is not None:
+            res = self._row_mapper(id, row_class, res)(res)
+        return res
 
     async def query_all(self, context_span: azs.SpanAbc, id: str, query: str,
-                        *args, timeout: float = None):
-        async with self.connection(context_span) as conn:
-            return await conn.query_all(context_span, id, query, *args,
-                                        timeout=timeout)
+                        *args, timeout: float = None,
+                        use_replica: bool = True, row_class: type = None):
+        """
+        :param row_class: namedtuple or class with __slots__ records are
+            mapped to, see Connection.query_one
+        """
+        res = await self._query('query_all', context_span, id, query, args,
+                                timeout, use_replica)
+        if row_class is not None:
+            res = self._map_rows(id, row_class, res)
+        return res
+
+    def _row_mapper(self, id: str, row_class: type, record):
+        columns = tuple(record.keys())
+        key = (id, row_class, columns)
+        mapper = self._row_mappers.get(key)
+        if mapper is None:
+            mapper = _make_row_mapper(row_class, columns)
+            self._row_mappers[key] = mapper
+        return mapper
+
+    def _map_rows(self, id: str, row_class: type, rows: list) -> list:
+        if not rows:
+            return rows
+        return list(map(self._row_mapper(id, row_class, rows[0]), rows))
+
+    async def _query(self, method, context_span, id, query, args, timeout,
+                     use_replica):
+        policy = self._result_policies.get(id)
+        if policy is None or self._result_cache is None:
+            async with self.read_connection(context_span,
+                                            use_replica) as conn:
+                return await getattr(conn, method)(context_span, id, query,
+                                                   *args, timeout=timeout)
+
+        key = (method, id, args)
+        try:
+            found, res = self._result_cache.get(key)
+        except TypeError:  # unhashable args
+            key, found, res = None, False, None
+        hits, misses = self._result_counters(id)
+        if found:
+            hits.inc()
+            with context_span.tracer.new_child(context_span.context) as span:
+                span.kind(az.CLIENT)
+                span.name("db:%s" % id)
+                span.remote_endpoint("postgres")
+                span.tag('db.cache', 'hit')
+            # lists are cached as tuples, every caller gets its own list
+            return list(res) if isinstance(res, tuple) else res
+        misses.inc()
+        ttl, tags = policy
+        generation = self._result_cache.generation(tags)
+        cm = self.read_connection(context_span, use_replica)
+        async with cm as conn:
+            res = await getattr(conn, method)(context_span, id, query,
+                                              *args, timeout=timeout)
+        if cm._replica is not None and \
+                self._result_cache.invalidated_within(tags,
+                                                      self.replica_max_lag):
+            # replica may not have replayed the invalidating write yet
+            key = None
+        if key is not None:
+            self._result_cache.set(key, tuple(res)
+                                   if isinstance(res, list) else res,
+                                   ttl, tags, generation)
+        return res
 
     async def execute(self, context_span: azs.SpanAbc, id: str, query: str,
-                      *args, timeout: float = None):
+                      *args, timeout: float = None,
+                      invalidate: Sequence[str] = ()):
+        """
+        :param invalidate: tags of cached results to drop after execution
+        """
+        try:
+            async with self.connection(context_span) as conn:
+                return await conn.execute(context_span, id, query, *args,
+                                          timeout=timeout)
+        finally:
+            if invalidate:
+                self.invalidate(*invalidate)
+
+    async def query_iter(self, context_span: azs.SpanAbc, id: str,
+                         query: str, *args, prefetch: int = 100,
+                         timeout: float = None, use_replica: bool = True,
+                         row_class: type = None):
+        """
+        Iterate over query results with server-side cursor, see
+        Connection.query_iter
+        """
+        async with self.read_connection(context_span, use_replica) as conn:
+            async for row in conn.query_iter(context_span, id, query, *args,
+                                             prefetch=prefetch,
+                                             timeout=timeout,
+                                             row_class=row_class):
+                yield row
+
+    async def execute_many(self, context_span: azs.SpanAbc, id: str,
+                           query: str, args: Iterable[Sequence],
+                           timeout: float = None):
+        async with self.connection(context_span) as conn:
+            return await conn.execute_many(context_span, id, query, args,
+                                           timeout=timeout)
+
+    async def fetch_many(self, context_span: azs.SpanAbc, id: str,
+                         query: str, args: Iterable[Sequence],
+                         timeout: float = None, use_replica: bool = True):
+        async with self.read_connection(context_span, use_replica) as conn:
+            return await conn.fetch_many(context_span, id, query, args,
+                                         timeout=timeout)
+
+    async def copy_records(self, context_span: azs.SpanAbc, id: str,
+                           table: str, records: Iterable[Sequence],
+                           columns: Sequence[str] = None,
+                           schema_name: str = None, timeout: float = None):
+        async with self.connection(context_span) as conn:
+            return await conn.copy_records(context_span, id, table, records,
+                                           columns, schema_name=schema_name,
+                                           timeout=timeout)
+
+    async def copy_records_stream(self, context_span: azs.SpanAbc, id: str,
+                                  table: str,
+                                  records: AsyncIterable[Sequence],
+                                  columns: Sequence[str] = None,
+                                  schema_name: str = None,
+                                  batch_size: int = 10000,
+                                  timeout: float = None):
         async with self.connection(context_span) as conn:
-            return await conn.execute(context_span, id, query, *args,
-                                      timeout=timeout)
+            return await conn.copy_records_stream(
+                context_span, id, table, records, columns,
+                schema_name=schema_name, batch_size=batch_size,
+                timeout=timeout)
+
+
+_NOT_FOUND = (False, None)
+
+
+class HashRing:
+    """
+    Consistent hashing shard router: key -> shard name. Adding a shard moves
+    only about 1/N of the keys. Hashing is stable across processes.
+    """
+
+    def __init__(self, shards: Iterable[str], vnodes: int = 100) -> None:
+        ring = []
+        for shard in shards:
+            for i in range(vnodes):
+                ring.append((self._hash('%s#%d' % (shard, i)), shard))
+        ring.sort()
+        self._hashes = [h for h, _ in ring]
+        self._shards = [shard for _, shard in ring]
+
+    @staticmethod
+    def _hash(key) -> int:
+        digest = hashlib.md5(str(key).encode()).digest()  # nosec
+        return int.from_bytes(digest[:8], 'big')
+
+    def __call__(self, key) -> str:
+        i = bisect.bisect(self._hashes, self._hash(key))
+        return self._shards[i % len(self._shards)]
+
+
+class LookupRouter:
+    """
+    Shard router by lookup table: key -> shard name
+    """
+
+    def __init__(self, table: Dict[Any, str],
+                 default: Optional[str] = None) -> None:
+        self.table = table
+        self.default = default
+
+    def __call__(self, key) -> str:
+        shard = self.table.get(key, self.default)
+        if shard is None:
+            raise UserWarning('No shard for key %r' % (key,))
+        return shard
+
+
+class ShardedPgDb(Component):
+    """
+    Set of PgDb shards. Queries are routed to a shard by key with router
+    function (HashRing by default), fan-out queries run on all shards
+    concurrently.
+    """
+
+    def __init__(self, dsns: Dict[str, str],
+                 router: Callable[[Any], str] = None, **kwargs) -> None:
+        """
+        :param dsns: shard name -> dsn
+        :param router: function returning shard name for a shard key
+        :param kwargs: PgDb parameters used for every shard
+        """
+        super(ShardedPgDb, self).__init__()
+        if not dsns:
+            raise UserWarning('No shards')
+        self.shards: Dict[str, PgDb] = OrderedDict(
+            (name, PgDb(dsn, **kwargs)) for name, dsn in dsns.items())
+        self.router = router or HashRing(self.shards)
+
+    def shard(self, key) -> PgDb:
+        name = self.router(key)
+        db = self.shards.get(name)
+        if db is None:
+            raise UserWarning('Unknown shard %s' % name)
+        return db
+
+    async def _each(self, method: str):
+        await asyncio.gather(*[getattr(db, method)()
+                               for db in self.shards.values()],
+                             loop=self.loop)
+
+    async def prepare(self):
+        for name, db in self.shards.items():
+            db.loop = self.loop
+            db.app = self.app
+            db.name = '%s.%s' % (self.name, name)
+        await self._each('prepare')
+
+    async def warmup(self):
+        await self._each('warmup')
+
+    async def start(self):
+        await self._each('start')
+
+    async def stop(self):
+        await self._each('stop')
+
+    def connection(self, context_span: azs.SpanAbc, key):
+        return self.shard(key).connection(context_span)
+
+    def read_connection(self, context_span: azs.SpanAbc, key,
+                        use_replica=True):
+        return self.shard(key).read_connection(context_span, use_replica)
+
+    async def query_one(self, context_span: azs.SpanAbc, key, id: str,
+                        query: str, *args, **kwargs):
+        return await self.shard(key).query_one(context_span, id, query,
+                                               *args, **kwargs)
+
+    async def query_all(self, context_span: azs.SpanAbc, key, id: str,
+                        query: str, *args, **kwargs):
+        return await self.shard(key).query_all(context_span, id, query,
+                                               *args, **kwargs)
+
+    async def execute(self, context_span: azs.SpanAbc, key, id: str,
+                      query: str, *args, **kwargs):
+        return await self.shard(key).execute(context_span, id, query,
+                                             *args, **kwargs)
+
+    async def query_iter(self, context_span: azs.SpanAbc, key, id: str,
+                         query: str, *args, **kwargs):
+        async for row in self.shard(key).query_iter(context_span, id, query,
+                                                    *args, **kwargs):
+            yield row
+
+    async def _fan_out(self, context_span: azs.SpanAbc, method: str,
+                       id: str, query: str, args, kwargs) -> Dict[str, Any]:
+        with context_span.tracer.new_child(context_span.context) as span, \
+                deadline.scope(span, deadline=deadline.get(context_span)):
+            span.name('db:fan_out:%s' % id)
+            span.tag('db.shards', str(len(self.shards)))
+            res = await asyncio.gather(
+                *[getattr(db, method)(span, id, query, *args, **kwargs)
+                  for db in self.shards.values()],
+                loop=self.loop)
+        return OrderedDict(zip(self.shards, res))
+
+    async def query_all_shards(self, context_span: azs.SpanAbc, id: str,
+                               query: str, *args,
+                               merge: Callable[[Dict[str, list]], Any] = None,
+                               **kwargs):
+        """
+        Run query_all on all shards concurrently
+
+        :param merge: function merging results given as dict shard name ->
+            rows, by default rows of all shards are concatenated in shard
+            order
+        """
+        res = await self._fan_out(context_span, 'query_all', id, query, args,
+                                  kwargs)
+        if merge is not None:
+            return merge(res)
+        return [row for rows in res.values() for row in rows]
+
+    async def execute_all_shards(self, context_span: azs.SpanAbc, id: str,
+                                 query: str, *args,
+                                 **kwargs) -> Dict[str, str]:
+        """
+        Run execute on all shards concurrently (e.g. for migrations)
+
+        :return: shard name -> status
+        """
+        return await self._fan_out(context_span, 'execute', id, query, args,
+                                   kwargs)
+
+
+def _approx_size(obj) -> int:
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple, asyncpg.Record)):
+        for item in obj:
+            size += _approx_size(item)
+    return size
+
+
+class Subscription:
+    """
+    Callback subscribed to NOTIFY on a channel, see PgDb.listen()
+    """
+
+    def __init__(self, db: 'PgDb', channel: str, callback,
+                 debounce: float) -> None:
+        self._db = db
+        self.channel = channel
+        self.callback = callback
+        self.debounce = debounce
+        self._payloads: List[str] = []
+        self._handle: asyncio.Handle = None
+
+    def push(self, payload: Optional[str]) -> None:
+        """
+        Schedule callback call, payload None only triggers the call
+        """
+        if payload is not None:
+            self._payloads.append(payload)
+        if self._handle is None:
+            self._handle = self._db.loop.call_later(self.debounce,
+                                                    self._dispatch)
+
+    def cancel(self) -> None:
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _dispatch(self) -> None:
+        self._handle = None
+        payloads, self._payloads = self._payloads, []
+        try:
+            res = self.callback(self.channel, payloads)
+            if asyncio.iscoroutine(res):
+                asyncio.ensure_future(self._wait(res), loop=self._db.loop)
+        except Exception as e:
+            self._db.app.log_err(e)
+
+    async def _wait(self, coro):
+        try:
+            await coro
+        except Exception as e:
+            self._db.app.log_err(e)
+
+
+class Listener:
+    """
+    Dedicated connection for LISTEN/NOTIFY. The connection is checked every
+    check_interval seconds and reconnected on failure.
+    """
+
+    def __init__(self, db: 'PgDb', check_interval: float) -> None:
+        self._db = db
+        self.check_interval = check_interval
+        self._conn = None  # type: asyncpg.connection.Connection
+        self._subs: Dict[str, List[Subscription]] = {}
+        self._lock = asyncio.Lock(loop=db.loop)
+        self._task: asyncio.Future = None
+
+    async def listen(self, channel: str, callback,
+                     debounce: float) -> Subscription:
+        sub = Subscription(self._db, channel, callback, debounce)
+        if self._task is None:
+            # also retries connection if it fails below
+            self._task = asyncio.ensure_future(self._checker(),
+                                               loop=self._db.loop)
+        async with self._lock:
+            subs = self._subs.setdefault(channel, [])
+            subs.append(sub)
+            if self._conn is None:
+                await self._connect()
+            elif len(subs) == 1:
+                await self._conn.add_listener(channel, self._notify)
+        return sub
+
+    async def unlisten(self, sub: Subscription) -> None:
+        sub.cancel()
+        async with self._lock:
+            subs = self._subs.get(sub.channel, [])
+            if sub in subs:
+                subs.remove(sub)
+            if not subs:
+                self._subs.pop(sub.channel, None)
+                if self._conn is not None:
+                    await self._conn.remove_listener(sub.channel,
+                                                     self._notify)
+
+    async def _connect(self):
+        self._db.app.log_info("Connecting to %s for notifications"
+                              "" % self._db._masked_dsn)
+        conn = await asyncpg.connect(self._db.dsn, loop=self._db.loop)
+        try:
+            for channel in self._subs:
+                await conn.add_listener(channel, self._notify)
+        except BaseException:
+            await conn.close()
+            raise
+        self._conn = conn
+
+    def _notify(self, conn, pid: int, channel: str, payload: str):
+        for sub in self._subs.get(channel, ()):
+            sub.push(payload)
+
+    async def _check(self):
+        async with self._lock:
+            if self._conn is not None:
+                try:
+                    await self._conn.fetchval('SELECT 1',
+                                              timeout=self.check_interval)
+                    return
+                except Exception as e:
+                    self._db.app.log_warn('Notification connection to %s is '
+                                          'lost: %s' % (self._db._masked_dsn,
+                                                        e))
+                    self._conn.terminate()
+                    self._conn = None
+            await self._connect()
+        # notifications could be missed while disconnected
+        for subs in self._subs.values():
+            for sub in subs:
+                sub.push(None)
+
+    async def _checker(self):
+        while True:
+            await asyncio.sleep(self.check_interval, loop=self._db.loop)
+            try:
+                await self._check()
+            except Exception as e:
+                self._db.app.log_err('Could not reconnect to %s for '
+                                     'notifications: %s'
+                                     '' % (self._db._masked_dsn, e))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for subs in self._subs.values():
+            for sub in subs:
+                sub.cancel()
+        if self._conn is not None:
+            await self._conn.close()
+            self._conn = None
+
+
+class ResultCache:
+    """
+    LRU cache of query results with per-entry TTL and tag invalidation,
+    bounded by approximate memory size of cached results.
+
+    Every tag has a generation which is incremented by invalidation. A
+    result read while one of its tags was invalidated is not stored, so a
+    read which started before a write can not cache stale data after the
+    invalidation. Replicas may still return data older than the
+    invalidation after it, see invalidated_within().
+    """
+
+    def __init__(self, max_size: int) -> None:
+        self.max_size = max_size
+        self.size = 0
+        # key: (expires, size, tags, result)
+        self._items: OrderedDict = OrderedDict()
+        self._tag_keys: Dict[str, Set[Any]] = {}
+        # tag -> generation, only for tags of cached queries
+        self._generations: Dict[str, int] = {}
+        # incremented by clear()
+        self._epoch = 0
+        # tag -> time.monotonic() of last invalidation, like generations
+        self._invalidated: Dict[str, float] = {}
+        self._cleared: Optional[float] = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key) -> Tuple[bool, Any]:
+        item = self._items.get(key)
+        if item is None:
+            return _NOT_FOUND
+        if item[0] < time.monotonic():
+            self._remove(key)
+            return _NOT_FOUND
+        self._items.move_to_end(key)
+        return True, item[3]
+
+    def generation(self, tags: tuple) -> tuple:
+        """
+        Generation of tags to be passed to set() of a result being read
+        """
+        gens = self._generations
+        return (self._epoch,) + tuple(gens.setdefault(tag, 0)
+                                      for tag in tags)
+
+    def invalidated_within(self, tags: tuple, period: float) -> bool:
+        """
+        Whether any of tags was invalidated in the last period seconds
+        """
+        since = time.monotonic() - period
+        if self._cleared is not None and self._cleared > since:
+            return True
+        invalidated = self._invalidated
+        return any(invalidated.get(tag, since) > since for tag in tags)
+
+    def set(self, key, result, ttl: float, tags: tuple,
+            generation: tuple = None) -> None:
+        """
+        :param generation: generation(tags) taken before the result was
+            read, the result is not stored if any of tags was invalidated
+            since then
+        """
+        if generation is not None and generation != self.generation(tags):
+            return
+        size = _approx_size(result)
+        if size > self.max_size:
+            return
+        if key in self._items:
+            self._remove(key)
+        self._items[key] = (time.monotonic() + ttl, size, tags, result)
+        self.size += size
+        for tag in tags:
+            self._tag_keys.setdefault(tag, set()).add(key)
+        while self.size > self.max_size:
+            self._remove(next(iter(self._items)))
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._tag_keys.clear()
+        self.size = 0
+        self._epoch += 1
+        self._cleared = time.monotonic()
+
+    def invalidate(self, tags: Iterable[str]) -> int:
+        count = 0
+        gens = self._generations
+        now = time.monotonic()
+        for tag in tags:
+            if tag in gens:
+                gens[tag] += 1
+                self._invalidated[tag] = now
+            for key in self._tag_keys.pop(tag, ()):
+                if key in self._items:
+                    self._remove(key)
+                    count += 1
+        return count
+
+    def _remove(self, key) -> None:
+        _, size, tags, _ = self._items.pop(key)
+        self.size -= size
+        for tag in tags:
+            keys = self._tag_keys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tag_keys[tag]
+
+
+class StatementCache:
+    """
+    LRU cache of prepared statements of a single connection keyed by query id
+    """
+
+    def __init__(self, db: PgDb, max_size: int) -> None:
+        self._db = db
+        self.max_size = max_size
+        self._stmts: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return len(self._stmts)
+
+    async def prepare(self, conn, id: str, query: str):
+        stmt = await conn.prepare(query)
+        self._stmts[id] = (query, stmt)
+        self._stmts.move_to_end(id)
+        while len(self._stmts) > self.max_size:
+            self._stmts.popitem(last=False)
+        return stmt
+
+    async def get(self, conn, id: str, query: str):
+        hits, misses = self._db._stmt_counters(id)
+        item = self._stmts.get(id)
+        if item is not None and item[0] == query:
+            self._stmts.move_to_end(id)
+            hits.inc()
+            return item[1]
+        misses.inc()
+        return await self.prepare(conn, id, query)
+
+    def invalidate(self, id: str) -> None:
+        self._stmts.pop(id, None)
 
 
 class ConnectionContextManager:
-    def __init__(self, db, context_span):
+    def __init__(self, db, context_span, replica: Replica = None):
         self._db = db
         self._conn = None
         self._context_span = context_span
+        self._replica = replica
+        if replica is None:
+            self._pool = db._pool
+            self._stats = db._pool_stats
+            self._sizer = db._pool_sizer
+        else:
+            self._pool = replica.pool
+            self._stats = replica.stats
+            self._sizer = None
+        self._start = None
 
     async def __aenter__(self):
-        with self._context_span.tracer.new_child(
-                self._context_span.context) as span:
-            span.kind(az.CLIENT)
-            span.name("db:Acquire")
-            span.remote_endpoint("postgres")
-            self._conn = await self._db._pool.acquire()
+        if self._replica is not None:
+            self._replica.in_flight += 1
+        stats = self._stats
+        start = time.monotonic()
+        if stats is not None:
+            stats.waiters.inc()
+        try:
+            with self._context_span.tracer.new_child(
+                    self._context_span.context) as span:
+                span.kind(az.CLIENT)
+                span.name("db:Acquire")
+                span.remote_endpoint("postgres")
+                if self._replica is not None:
+                    span.tag('db.replica', self._replica.masked_dsn)
+                if self._sizer is not None:
+                    await self._sizer.acquire(
+                        deadline.limit_timeout(self._context_span, None))
+                try:
+                    self._conn = await self._pool.acquire(
+                        timeout=deadline.limit_timeout(self._context_span,
+                                                       None))
+                except BaseException:
+                    if self._sizer is not None:
+                        self._sizer.release()
+                    raise
+        except BaseException:
+            if self._replica is not None:
+                self._replica.in_flight -= 1
+            raise
+        finally:
+            if stats is not None:
+                stats.waiters.dec()
+        self._start = time.monotonic()
+        wait_ms = (self._start - start) * 1000
+        if stats is not None:
+            stats.acquire_ms.observe(wait_ms)
+            stats.in_use.inc()
+        if self._sizer is not None:
+            self._sizer.observe_wait(wait_ms)
         c = Connection(self._db, self._conn)
         return c
 
     async def __aexit__(self, exc_type, exc, tb):
-        await self._db._pool.release(self._conn)
+        try:
+            await self._pool.release(self._conn)
+        finally:
+            if self._sizer is not None:
+                self._sizer.release()
+            if self._stats is not None:
+                self._stats.in_use.dec()
+            if self._replica is not None:
+                self._replica.in_flight -= 1
+                self._replica.observe((time.monotonic() - self._start) * 1000)
 
 
 class TransactionContextManager:
+    """
+    Transaction (or savepoint, if nested) on a connection.
+
+    BEGIN is deferred until the first statement and is sent in the same
+    round trip when possible, a transaction without statements costs no
+    round trips at all. The whole transaction is recorded as a single span
+    with statement count and duration tags.
+    """
+
     def __init__(self, context_span, conn, isolation_level=None):
         """
         :type context_span: azs.SpanAbc
@@ -145,25 +1601,62 @@ class TransactionContextManager:
         self._conn = conn
         self._isolation_level = isolation_level
         self._context_span = context_span
+        self._savepoint: str = None
+        self._begun = False
+        self._span: azs.SpanAbc = None
+        self._start: float = None
+        self.statements = 0
 
     def _begin_query(self):
+        if self._savepoint is not None:
+            return "SAVEPOINT %s" % self._savepoint
         query = "BEGIN TRANSACTION"
         if self._isolation_level:
             query += " ISOLATION LEVEL %s" % self._isolation_level
         return query
 
+    def _end_query(self, rollback):
+        if self._savepoint is not None:
+            if rollback:
+                return "ROLLBACK TO SAVEPOINT %s" % self._savepoint
+            return "RELEASE SAVEPOINT %s" % self._savepoint
+        return "ROLLBACK" if rollback else "COMMIT"
+
     async def __aenter__(self):
-        await self._conn.execute(self._context_span,
-                                 query=self._begin_query(),
-                                 id="BeginTransaction")
+        conn = self._conn
+        if conn._in_xact():
+            self._savepoint = 'aioapp_sp_%d' % (len(conn._xacts) + 1)
+        span = self._context_span.tracer.new_child(self._context_span.context)
+        span.kind(az.CLIENT)
+        span.name("db:Transaction" if self._savepoint is None
+                  else "db:Savepoint")
+        span.remote_endpoint("postgres")
+        if self._isolation_level:
+            span.tag('db.isolation_level', self._isolation_level)
+        span.__enter__()
+        self._span = span
+        self._start = time.monotonic()
+        conn._xacts.append(self)
+        return self
 
     async def __aexit__(self, exc_type, exc, tb):
-        if exc:
-            await self._conn.execute(self._context_span,
-                                     query="ROLLBACK", id="Rollback")
-        else:
-            await self._conn.execute(self._context_span,
-                                     query="COMMIT", id="Commit")
+        conn = self._conn
+        conn._xacts.remove(self)
+        rollback = exc is not None
+        try:
+            if self._begun and (not rollback or
+                                conn._conn.is_in_transaction()):
+                await conn._conn.execute(self._end_query(rollback))
+        finally:
+            span = self._span
+            span.tag('db.statements', str(self.statements))
+            span.tag('db.duration_ms',
+                     '%.3f' % ((time.monotonic() - self._start) * 1000))
+            if not self._begun:
+                span.tag('db.result', 'empty')
+            else:
+                span.tag('db.result', 'rollback' if rollback else 'commit')
+            span.__exit__(exc_type, exc, tb)
 
 
 class Connection:
@@ -173,6 +1666,69 @@ class Connection:
         """
         self._db = db
         self._conn = conn
+        self._xacts: List[TransactionContextManager] = []
+        self._explain_entry: tuple = None
+
+    def _in_xact(self) -> bool:
+        return bool(self._xacts) or self._conn.is_in_transaction()
+
+    def _take_pending_begin(self) -> List[str]:
+        queries = []
+        for xact in self._xacts:
+            if not xact._begun:
+                xact._begun = True
+                queries.append(xact._begin_query())
+        return queries
+
+    async def _ensure_begun(self):
+        if self._xacts and not self._xacts[-1]._begun:
+            await self._conn.execute('; '.join(self._take_pending_begin()))
+
+    def _span(self, context_span: azs.SpanAbc, id: str, query: str,
+              args=(), explain: bool = False) -> QueryTrace:
+        """
+        :param explain: plan of the query may be captured if it is slow,
+            only for read queries (query_one, query_all)
+        """
+        # plan is captured right after the query it belongs to
+        self._explain_entry = None
+        stats = self._db._conn_stats.get(_raw_conn(self._conn))
+        if stats is not None:
+            stats.queries += 1
+        for xact in self._xacts:
+            xact.statements += 1
+        return QueryTrace(self, context_span, id, query, args, explain)
+
+    async def _explain_slow(self):
+        """
+        Capture plan of sampled slow query. The query is run again with
+        EXPLAIN ANALYZE inside a transaction (savepoint) that is rolled back.
+        """
+        entry, query, args = self._explain_entry
+        self._explain_entry = None
+        # asyncpg transaction() can not be used inside of a manually
+        # started (deferred) transaction, so the statements are sent by hand
+        if self._conn.is_in_transaction():
+            begin = 'SAVEPOINT aioapp_explain'
+            rollback = 'ROLLBACK TO SAVEPOINT aioapp_explain; ' \
+                       'RELEASE SAVEPOINT aioapp_explain'
+        else:
+            begin, rollback = 'BEGIN', 'ROLLBACK'
+        begun = False
+        try:
+            await self._conn.execute(begin)
+            begun = True
+            plan = await self._conn.fetch(
+                'EXPLAIN (ANALYZE, BUFFERS) ' + query, *args)
+            entry['plan'] = '\n'.join(row[0] for row in plan)
+            self._db.app.log_warn('Slow query %s plan:\n%s'
+                                  '' % (entry['id'], entry['plan']))
+        except Exception as e:
+            self._db.app.log_warn('Could not explain slow query %s: %s'
+                                  '' % (entry['id'], e))
+        finally:
+            if begun:
+                await self._conn.execute(rollback)
 
     def xact(self, context_span, isolation_level=None):
         """
@@ -182,32 +1738,296 @@ class Connection:
         """
         return TransactionContextManager(context_span, self, isolation_level)
 
+    async def _run_stmt(self, method: str, id: str, query: str, args,
+                        timeout: float):
+        await self._ensure_begun()
+        cache = self._db._stmt_cache(self._conn)
+        if cache is None:
+            return await getattr(self._conn, method)(query, *args,
+                                                     timeout=timeout)
+        stmt = await cache.get(self._conn, id, query)
+        try:
+            return await _call_stmt(stmt, method, args, timeout)
+        except asyncpg.exceptions.InvalidCachedStatementError:
+            # schema changed, statement must be prepared again
+            cache.invalidate(id)
+            if self._conn.is_in_transaction():
+                raise
+            stmt = await cache.get(self._conn, id, query)
+            return await _call_stmt(stmt, method, args, timeout)
+
     async def execute(self, context_span: azs.SpanAbc, id: str,
                       query: str, *args, timeout: float = None):
-        with context_span.tracer.new_child(context_span.context) as span:
-            span.kind(az.CLIENT)
-            span.name("db:%s" % id)
-            span.remote_endpoint("postgres")
-            span.annotate(repr(args))
-            res = await self._conn.execute(query, *args, timeout=timeout)
+        timeout = deadline.limit_timeout(context_span, timeout)
+        with self._span(context_span, id, query, args) as span:
+            annotate_lazy(span, repr, args)
+            if args:
+                res = await self._run_stmt('execute', id, query, args,
+                                           timeout)
+            else:
+                # simple query protocol allows multiple statements, so
+                # deferred BEGIN is sent in the same round trip
+                pending = self._take_pending_begin()
+                if pending:
+                    query = '; '.join(pending + [query])
+                res = await self._conn.execute(query, timeout=timeout)
         return res
 
     async def query_one(self, context_span: azs.SpanAbc, id: str,
-                        query: str, *args, timeout: float = None):
-        with context_span.tracer.new_child(context_span.context) as span:
-            span.kind(az.CLIENT)
-            span.name("db:%s" % id)
-            span.remote_endpoint("postgres")
-            span.annotate(repr(args))
-            res = await self._conn.fetchrow(query, *args, timeout=timeout)
+                        query: str, *args, timeout: float = None,
+                        row_class: type = None):
+        """
+        :param row_class: namedtuple or class with __slots__ the record is
+            mapped to instead of asyncpg.Record. Fields are filled from the
+            columns of the same names (__init__ of the class is not called).
+            The mapper is generated once per query id and column set.
+        """
+        timeout = deadline.limit_timeout(context_span, timeout)
+        with self._span(context_span, id, query, args,
+                        explain=True) as span:
+            annotate_lazy(span, repr, args)
+            res = await self._run_stmt('fetchrow', id, query, args, timeout)
+        if self._explain_entry is not None:
+            await self._explain_slow()
+        if row_class is not None and res is not None:
+            res = self._db._row_mapper(id, row_class, res)(res)
         return res
 
     async def query_all(self, context_span: azs.SpanAbc, id: str,
-                        query: str, *args, timeout: float = None):
-        with context_span.tracer.new_child(context_span.context) as span:
-            span.kind(az.CLIENT)
-            span.name("db:%s" % id)
-            span.remote_endpoint("postgres")
-            span.annotate(repr(args))
-            res = await self._conn.fetch(query, *args, timeout=timeout)
+                        query: str, *args, timeout: float = None,
+                        row_class: type = None):
+        """
+        :param row_class: see query_one
+        """
+        timeout = deadline.limit_timeout(context_span, timeout)
+        with self._span(context_span, id, query, args,
+                        explain=True) as span:
+            annotate_lazy(span, repr, args)
+            res = await self._run_stmt('fetch', id, query, args, timeout)
+        if self._explain_entry is not None:
+            await self._explain_slow()
+        if row_class is not None:
+            res = self._db._map_rows(id, row_class, res)
         return res
+
+    async def query_iter(self, context_span: azs.SpanAbc, id: str,
+                         query: str, *args, prefetch: int = 100,
+                         timeout: float = None, row_class: type = None):
+        """
+        Async generator over query results fetched from a server-side cursor
+        by prefetch rows, so memory usage does not depend on result size.
+        A transaction is started if the connection is not in one already.
+
+        :param row_class: see query_one
+        """
+        trace = self._span(context_span, id, query, args)
+        with trace as span:
+            annotate_lazy(span, repr, args)
+            if self._in_xact():
+                async for row in self._iter_cursor(context_span, trace, id,
+                                                   query, args, prefetch,
+                                                   timeout, row_class):
+                    yield row
+            else:
+                async with self.xact(context_span):
+                    async for row in self._iter_cursor(
+                            context_span, trace, id, query, args, prefetch,
+                            timeout, row_class):
+                        yield row
+
+    async def _iter_cursor(self, context_span, trace, id, query, args,
+                           prefetch, timeout, row_class):
+        span = trace.span
+        rows = 0
+        fetches = 0
+        cur = await self._cursor(id, query, args)
+        while True:
+            batch = await cur.fetch(
+                prefetch,
+                timeout=deadline.limit_timeout(context_span, timeout))
+            fetches += 1
+            rows += len(batch)
+            # tagged before yielding, consumer may stop iteration any time
+            span.tag('db.rows', str(rows))
+            span.tag('db.fetches', str(fetches))
+            if row_class is not None:
+                batch = self._db._map_rows(id, row_class, batch)
+            # consumer's time is not query time
+            trace.pause()
+            for row in batch:
+                yield row
+            trace.resume()
+            if len(batch) < prefetch:
+                break
+
+    async def _cursor(self, id: str, query: str, args):
+        await self._ensure_begun()
+        cache = self._db._stmt_cache(self._conn)
+        if cache is None:
+            return await self._conn.cursor(query, *args)
+        stmt = await cache.get(self._conn, id, query)
+        return await stmt.cursor(*args)
+
+    async def execute_many(self, context_span: azs.SpanAbc, id: str,
+                           query: str, args: Iterable[Sequence],
+                           timeout: float = None):
+        """
+        Execute query for every set of arguments. Bind/execute messages of the
+        whole batch are sent in a single exchange.
+        """
+        args = list(args)
+        timeout = deadline.limit_timeout(context_span, timeout)
+        with self._span(context_span, id, query) as span:
+            span.tag('db.batch_size', str(len(args)))
+            await self._ensure_begun()
+            await self._conn.executemany(query, args, timeout=timeout)
+
+    async def fetch_many(self, context_span: azs.SpanAbc, id: str,
+                         query: str, args: Iterable[Sequence],
+                         timeout: float = None) -> list:
+        """
+        Fetch query results for every set of arguments using a single
+        prepared statement and a single span
+
+        :return: list of results (list of records) in order of args
+        """
+        args = list(args)
+        with self._span(context_span, id, query) as span:
+            span.tag('db.batch_size', str(len(args)))
+            res = []
+            for stmt_args in args:
+                res.append(await self._run_stmt(
+                    'fetch', id, query, stmt_args,
+                    deadline.limit_timeout(context_span, timeout)))
+        return res
+
+    async def copy_records(self, context_span: azs.SpanAbc, id: str,
+                           table: str, records: Iterable[Sequence],
+                           columns: Sequence[str] = None,
+                           schema_name: str = None, timeout: float = None):
+        """
+        Bulk insert records with binary COPY protocol
+
+        :return: COPY command status, e.g. "COPY 100"
+        """
+        timeout = deadline.limit_timeout(context_span, timeout)
+        with self._span(context_span, id, table) as span:
+            span.tag('db.table', table)
+            await self._ensure_begun()
+            res = await self._conn.copy_records_to_table(
+                table, records=records, columns=columns,
+                schema_name=schema_name, timeout=timeout)
+            span.tag('db.rows', str(_copy_rows(res)))
+        return res
+
+    async def copy_records_stream(self, context_span: azs.SpanAbc, id: str,
+                                  table: str,
+                                  records: AsyncIterable[Sequence],
+                                  columns: Sequence[str] = None,
+                                  schema_name: str = None,
+                                  batch_size: int = 10000,
+                                  timeout: float = None) -> int:
+        """
+        Bulk insert records from async iterator with binary COPY protocol.
+        Records are sent by batches of batch_size, so memory usage does not
+        depend on the number of records. Wrap the call in a transaction to
+        make it atomic.
+
+        :return: number of inserted rows
+        """
+        with self._span(context_span, id, table) as span:
+            span.tag('db.table', table)
+            rows = 0
+            batches = 0
+            batch: list = []
+            async for record in records:
+                batch.append(record)
+                if len(batch) >= batch_size:
+                    rows += await self._copy_batch(
+                        table, batch, columns, schema_name,
+                        deadline.limit_timeout(context_span, timeout))
+                    batches += 1
+                    batch = []
+            if batch:
+                rows += await self._copy_batch(
+                    table, batch, columns, schema_name,
+                    deadline.limit_timeout(context_span, timeout))
+                batches += 1
+            span.tag('db.rows', str(rows))
+            span.tag('db.batches', str(batches))
+        return rows
+
+    async def _copy_batch(self, table, batch, columns, schema_name, timeout):
+        await self._ensure_begun()
+        res = await self._conn.copy_records_to_table(
+            table, records=batch, columns=columns, schema_name=schema_name,
+            timeout=timeout)
+        return _copy_rows(res)
+
+
+def _raw_conn(conn):
+    # pool returns connection proxies, per-connection state belongs to the
+    # underlying connection
+    return getattr(conn, '_con', conn)
+
+
+def _copy_rows(status: str) -> int:
+    # status is "COPY <rows>"
+    try:
+        return int(status.rsplit(' ', 1)[-1])
+    except (AttributeError, ValueError):
+        return 0
+
+
+async def _call_stmt(stmt, method: str, args, timeout: float):
+    if method == 'execute':
+        # asyncpg 0.14 prepared statements have no execute(), rows returned
+        # by the statement are fetched and dropped
+        await stmt.fetch(*args, timeout=timeout)
+        return stmt.get_statusmsg()
+    return await getattr(stmt, method)(*args, timeout=timeout)
+
+
+def _row_class_fields(row_class: type) -> Tuple[str, ...]:
+    fields = getattr(row_class, '_fields', None)
+    if fields is not None:
+        return tuple(fields)
+    fields = []
+    for cls in reversed(row_class.__mro__):
+        slots = cls.__dict__.get('__slots__', ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        fields.extend(slot for slot in slots
+                      if slot not in ('__dict__', '__weakref__'))
+    return tuple(fields)
+
+
+def _make_row_mapper(row_class: type, columns: Tuple[str, ...]) -> Callable:
+    """
+    Compile function mapping a record with columns to row_class instance
+    """
+    fields = _row_class_fields(row_class)
+    if not fields:
+        raise UserWarning('row_class %s must be a namedtuple or a class with '
+                          '__slots__' % row_class.__name__)
+    missing = [field for field in fields if field not in columns]
+    if missing:
+        raise UserWarning('No columns for fields %s of %s'
+                          '' % (', '.join(missing), row_class.__name__))
+    index = [columns.index(field) for field in fields]
+    if issubclass(row_class, tuple):
+        if index == list(range(len(columns))):
+            return partial(tuple.__new__, row_class)
+        values = ''.join('rec[%d], ' % i for i in index)
+        src = 'def mapper(rec):\n    return _new(_cls, (%s))\n' % values
+        namespace = {'_new': tuple.__new__, '_cls': row_class}
+    else:
+        lines = ['def mapper(rec):', '    obj = _new(_cls)']
+        lines.extend('    obj.%s = rec[%d]' % (field, i)
+                     for field, i in zip(fields, index))
+        lines.append('    return obj')
+        src = '\n'.join(lines) + '\n'
+        namespace = {'_new': object.__new__, '_cls': row_class}
+    exec(compile(src, '<row mapper %s>' % row_class.__name__, 'exec'),
+         namespace)  # nosec
+    return namespace['mapper']
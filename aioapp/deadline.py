@@ -0,0 +1,86 @@
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Optional  # noqa
+import aiozipkin.span as azs  # noqa
+from .error import DeadlineExceededError
+
+
+HEADER = 'X-Request-Timeout'
+
+# absolute deadlines (time.time()) of requests (tasks) being processed, by
+# the span object of the request. Trace ids can not be used as keys, they
+# come from clients and are shared by concurrent requests.
+_deadlines: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+@contextmanager
+def scope(context_span: azs.SpanAbc, timeout: Optional[float] = None,
+          deadline: Optional[float] = None):
+    """
+    Attach deadline to context_span for the duration of the block. Every
+    component call made with the span sees the deadline (child spans do
+    not, pass the request span to components). A deadline can only be
+    shortened by a nested scope.
+
+    :param timeout: seconds from now
+    :param deadline: absolute unix time
+    """
+    if timeout is not None:
+        by_timeout = time.time() + timeout
+        deadline = by_timeout if deadline is None \
+            else min(deadline, by_timeout)
+    if context_span is None or deadline is None:
+        yield deadline
+        return
+    prev = _deadlines.get(context_span)
+    if prev is not None:
+        deadline = min(prev, deadline)
+    _deadlines[context_span] = deadline
+    try:
+        yield deadline
+    finally:
+        if prev is None:
+            _deadlines.pop(context_span, None)
+        else:
+            _deadlines[context_span] = prev
+
+
+def get(context_span: azs.SpanAbc) -> Optional[float]:
+    """
+    Absolute deadline (unix time) attached to the span or None
+    """
+    if context_span is None:
+        return None
+    return _deadlines.get(context_span)
+
+
+def time_left(context_span: azs.SpanAbc) -> Optional[float]:
+    """
+    Seconds left till the deadline of the span, None if there is no
+    deadline
+
+    :raises DeadlineExceededError: if the deadline has passed
+    """
+    deadline = get(context_span)
+    if deadline is None:
+        return None
+    left = deadline - time.time()
+    if left <= 0:
+        raise DeadlineExceededError('Deadline exceeded by %.3f s' % -left)
+    return left
+
+
+def limit_timeout(context_span: azs.SpanAbc,
+                  timeout: Optional[float]) -> Optional[float]:
+    """
+    Shorten timeout of a call to the time left till the deadline
+
+    :raises DeadlineExceededError: if the deadline has passed
+    """
+    left = time_left(context_span)
+    if left is None:
+        return timeout
+    if timeout is None:
+        return left
+    return min(timeout, left)
@@ -32,3 +32,7 @@ class BadTaskParamsError(Error):
 
 class PayErrorException(Error):
     pass
+
+
+class DeadlineExceededError(Error):
+    pass
@@ -1,7 +1,14 @@
 from abc import ABCMeta
 import io
-from typing import Type, Any
+import os
+import socket
+import zlib
+import gzip
+from collections import OrderedDict
+from concurrent.futures import Executor  # noqa
+from typing import Type, Any, Optional, List
 from functools import partial
+import time
 import asyncio
 import traceback
 from urllib.parse import urlparse
@@ -10,15 +17,28 @@ from aiohttp import ClientResponse
 from aiohttp.payload import BytesPayload
 from aiohttp import client_exceptions, TCPConnector
 from .app import Component
+from .misc import json_dumps_bytes, json_loads
+from .error import DeadlineExceededError
+from .tracer import annotate_lazy
+from . import deadline
 import logging
 import aiozipkin as az
 import aiozipkin.aiohttp_helpers as azah
 import aiozipkin.span as azs
 import aiozipkin.constants as azc
 
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
 
 access_logger = logging.getLogger('aiohttp.access')
 SPAN_KEY = 'zipkin_span'
+SD_LISTEN_FDS_START = 3
+LISTEN_FDS_ENV = 'AIOAPP_LISTEN_FDS'
+# attribute of responses marked by cache_compressed()
+_COMPRESSION_CACHE_ATTR = '_aioapp_compression_cache'
 
 
 class Handler(object):
@@ -38,12 +58,300 @@ class ResponseCodec:
                      response: ClientResponse) -> Any:
         raise NotImplementedError()
 
+    async def encode(self, context_span: azs.SpanAbc, request: web.Request,
+                     data: Any) -> web.StreamResponse:
+        raise NotImplementedError()
+
+
+class RequestCodec:
+
+    async def decode(self, context_span: azs.SpanAbc,
+                     request: web.Request) -> Any:
+        raise NotImplementedError()
+
+
+class JsonCodec(RequestCodec, ResponseCodec):
+    """
+    JSON codec for both server routes and client responses. Uses orjson when
+    it is installed. Encoded bodies larger than stream_min_size are written
+    to the client in chunks of chunk_size bytes without extra copies.
+    """
+
+    def __init__(self, status: int = 200,
+                 content_type: str = 'application/json',
+                 stream_min_size: int = 1024 * 1024,
+                 chunk_size: int = 64 * 1024) -> None:
+        self.status = status
+        self.content_type = content_type
+        self.stream_min_size = stream_min_size
+        self.chunk_size = chunk_size
+
+    async def decode(self, context_span, request_or_response) -> Any:
+        body = await request_or_response.read()
+        if not body:
+            return None
+        try:
+            return json_loads(body)
+        except ValueError:
+            if isinstance(request_or_response, web.BaseRequest):
+                raise web.HTTPBadRequest(text='Invalid JSON')
+            raise
+
+    async def encode(self, context_span: azs.SpanAbc, request: web.Request,
+                     data: Any) -> web.StreamResponse:
+        body = json_dumps_bytes(data)
+        if len(body) < self.stream_min_size:
+            return web.Response(body=body, status=self.status,
+                                content_type=self.content_type)
+
+        resp = web.StreamResponse(status=self.status)
+        resp.content_type = self.content_type
+        resp.content_length = len(body)
+        await resp.prepare(request)
+        view = memoryview(body)
+        for i in range(0, len(body), self.chunk_size):
+            await resp.write(view[i:i + self.chunk_size])
+        await resp.write_eof()
+        return resp
+
+
+class RouteStats:
+    """
+    Always-on per-route metrics: in-flight gauge and latency histogram (ms)
+    per response status. Recorded for every request, sampled or not.
+    """
+
+    def __init__(self, server: 'Server', method: str, uri: str) -> None:
+        self.server = server
+        self.tags = {'method': method.upper(), 'route': uri}
+        self._latency: dict = {}
+        self._codec: dict = {}
+        self._in_flight = None
+
+    @property
+    def _metrics(self):
+        return self.server.app._metrics
+
+    @property
+    def in_flight(self):
+        if self._in_flight is None:
+            self._in_flight = self._metrics.gauge('http_server_in_flight',
+                                                  self.tags)
+        return self._in_flight
+
+    def observe(self, status: int, duration_ms: float) -> None:
+        hist = self._latency.get(status)
+        if hist is None:
+            tags = dict(self.tags, status=status)
+            hist = self._metrics.histogram('http_server_latency_ms', tags)
+            self._latency[status] = hist
+        hist.observe(duration_ms)
+
+    def observe_codec(self, stage: str, duration_ms: float) -> None:
+        hist = self._codec.get(stage)
+        if hist is None:
+            hist = self._metrics.histogram('http_server_%s_ms' % stage,
+                                           self.tags)
+            self._codec[stage] = hist
+        hist.observe(duration_ms)
+
+
+class Compression:
+    """
+    Response compression negotiated by Accept-Encoding.
+
+    Bodies smaller than min_size are sent as is, bodies larger than
+    executor_min_size are compressed in the executor (default thread pool)
+    to keep the loop responsive. Compressed forms of responses marked with
+    cache_compressed() (static or cached bodies) are cached by body content,
+    so they are compressed only once. Other bodies are never cached.
+    """
+
+    def __init__(self, min_size: int = 1024,
+                 executor_min_size: int = 65536,
+                 encodings=('br', 'gzip', 'deflate'),
+                 level: int = 6,
+                 cache_max_size: int = 64 * 1024 * 1024,
+                 executor: Optional[Executor] = None) -> None:
+        self.min_size = min_size
+        self.executor_min_size = executor_min_size
+        self.encodings = tuple(enc for enc in encodings
+                               if enc != 'br' or brotli is not None)
+        self.level = level
+        self.cache_max_size = cache_max_size
+        self.executor = executor
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_size = 0
+
+    def choose_encoding(self, accept_encoding: str) -> Optional[str]:
+        if not accept_encoding:
+            return None
+        accepted = {}
+        for item in accept_encoding.split(','):
+            enc, _, params = item.partition(';')
+            q = 1.0
+            params = params.strip()
+            if params.startswith('q='):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    q = 0.
+            accepted[enc.strip().lower()] = q
+        best = None
+        best_q = 0.
+        for enc in self.encodings:
+            q = accepted.get(enc, accepted.get('*', 0.))
+            if q > best_q:
+                best, best_q = enc, q
+        return best
+
+    def _compress(self, encoding: str, data: bytes) -> bytes:
+        if encoding == 'gzip':
+            return gzip.compress(data, self.level)
+        elif encoding == 'deflate':
+            return zlib.compress(data, self.level)
+        elif encoding == 'br':
+            return brotli.compress(data, quality=self.level)
+        raise UserWarning('Unsupported encoding %s' % encoding)
+
+    def _cache_get(self, encoding: str, data: bytes) -> Optional[bytes]:
+        key = (encoding, data)
+        compressed = self._cache.get(key)
+        if compressed is not None:
+            self._cache.move_to_end(key)
+        return compressed
+
+    def _cache_set(self, encoding: str, data: bytes, compressed: bytes):
+        size = len(data) + len(compressed)
+        if size > self.cache_max_size:
+            return
+        key = (encoding, data)
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self._cache_size -= len(data) + len(old)
+        self._cache[key] = compressed
+        self._cache_size += size
+        while self._cache_size > self.cache_max_size:
+            (_, old_data), old_comp = self._cache.popitem(last=False)
+            self._cache_size -= len(old_data) + len(old_comp)
+
+    async def compress(self, loop, request: web.Request,
+                       resp: web.StreamResponse) -> web.StreamResponse:
+        if not isinstance(resp, web.Response) or \
+                isinstance(resp, web.HTTPException):
+            return resp
+        body = resp.body
+        if not isinstance(body, bytes) or len(body) < self.min_size:
+            return resp
+        if resp.status < 200 or resp.status in (204, 304) or \
+                'Content-Encoding' in resp.headers:
+            return resp
+        encoding = self.choose_encoding(
+            request.headers.get('Accept-Encoding', ''))
+        if encoding is None:
+            return resp
+
+        cacheable = getattr(resp, _COMPRESSION_CACHE_ATTR, False)
+        compressed = self._cache_get(encoding, body) if cacheable else None
+        if compressed is None:
+            if len(body) >= self.executor_min_size:
+                compressed = await loop.run_in_executor(
+                    self.executor, self._compress, encoding, body)
+            else:
+                compressed = self._compress(encoding, body)
+            if cacheable:
+                self._cache_set(encoding, body, compressed)
+
+        resp.body = compressed
+        resp.headers['Content-Encoding'] = encoding
+        resp.headers.add('Vary', 'Accept-Encoding')
+        return resp
+
+
+def cache_compressed(resp: web.Response) -> web.Response:
+    """
+    Mark response with a static (or otherwise cached) body, so compressed
+    forms of the body are cached by Compression
+    """
+    setattr(resp, _COMPRESSION_CACHE_ATTR, True)
+    return resp
+
+
+def inherited_fds(environ=None) -> List[int]:
+    """
+    Listening socket descriptors inherited from the parent process: either
+    passed by systemd socket activation (LISTEN_FDS, LISTEN_PID) or handed
+    off by a previous server process (see Server.handoff_env)
+    """
+    if environ is None:
+        environ = os.environ
+    if environ.get(LISTEN_FDS_ENV):
+        return [int(fd) for fd in environ[LISTEN_FDS_ENV].split(',')]
+    if environ.get('LISTEN_FDS'):
+        pid = environ.get('LISTEN_PID')
+        if pid is not None and int(pid) != os.getpid():
+            return []
+        return list(range(SD_LISTEN_FDS_START,
+                          SD_LISTEN_FDS_START + int(environ['LISTEN_FDS'])))
+    return []
+
+
+def _as_socket(sock) -> socket.socket:
+    if not isinstance(sock, int):
+        return sock
+    if not hasattr(socket, 'SO_DOMAIN'):
+        # family and type are detected from descriptor (python 3.7+)
+        return socket.socket(fileno=sock)
+    # python 3.6 does not detect family and type of the descriptor, so they
+    # are read with getsockopt. fromfd duplicates the descriptor.
+    probe = socket.socket(fileno=sock)
+    try:
+        family = probe.getsockopt(socket.SOL_SOCKET, socket.SO_DOMAIN)
+        type_ = probe.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+        return socket.fromfd(sock, family, type_)
+    finally:
+        probe.close()
+
+
+def _bind_reuse_port(host: str, port: int) -> socket.socket:
+    family, type_, proto, _, addr = socket.getaddrinfo(
+        host, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)[0]
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(addr)
+    except Exception:
+        sock.close()
+        raise
+    return sock
+
 
 class Server(Component):
 
-    def __init__(self, host: str, port: int, handler: Type[Handler],
+    def __init__(self, host: Optional[str], port: Optional[int],
+                 handler: Type[Handler],
                  access_log_format=None, access_log=access_logger,
-                 shutdown_timeout=60.0) -> None:
+                 shutdown_timeout=60.0,
+                 compression: Optional[Compression] = None,
+                 path: Optional[str] = None, sock=None,
+                 backlog: int = 128, reuse_port: bool = False,
+                 request_timeout: Optional[float] = None) -> None:
+        """
+        :param host: TCP host to bind, None to listen only on path/sock
+        :param port: TCP port to bind
+        :param path: Unix domain socket path
+        :param sock: pre-bound socket or descriptor (or a list of them),
+            e.g. http.inherited_fds() for systemd socket activation
+        :param backlog: listen backlog
+        :param reuse_port: bind TCP socket with SO_REUSEPORT, so a new
+            process can bind the same port before the old one stops
+        :param request_timeout: handler timeout (seconds). Client may set
+            a shorter one with X-Request-Timeout header. The deadline is
+            attached to the request trace and shortens timeouts of db, http
+            client, telegram calls and scheduled tasks made with it. Request
+            that exceeds it is cancelled with 504 response.
+        """
         if not issubclass(handler, Handler):
             raise UserWarning()
         super(Server, self).__init__()
@@ -52,10 +360,16 @@ class Server(Component):
                                            self.wrap_middleware, ])
         self.host = host
         self.port = port
+        self.path = path
+        self.sock = sock
+        self.backlog = backlog
+        self.reuse_port = reuse_port
         self.error_handler = None
         self.access_log_format = access_log_format
         self.access_log = access_log
         self.shutdown_timeout = shutdown_timeout
+        self.compression = compression
+        self.request_timeout = request_timeout
         self.web_app_handler = None
         self.servers = None
         self.server_creations = None
@@ -64,52 +378,86 @@ class Server(Component):
 
     async def wrap_middleware(self, app, handler):
         async def middleware_handler(request: web.Request):
-            if self.app._tracer:
-                context = az.make_context(request.headers)
-                if context is None:
-                    sampled = azah.parse_sampled(request.headers)
-                    debug = azah.parse_debug(request.headers)
-                    span = self.app._tracer.new_trace(sampled=sampled,
-                                                      debug=debug)
-                else:
-                    span = self.app._tracer.join_span(context)
-                request[SPAN_KEY] = span
-
-                if span.is_noop:
-                    resp, trace_str = await self._error_handle(span, request,
-                                                               handler)
-                    return resp
-
-                with span:
-                    span_name = '{0} {1}'.format(request.method.upper(),
-                                                 request.path)
-                    span.name(span_name)
-                    span.kind(azah.SERVER)
-                    span.tag(azah.HTTP_PATH, request.path)
-                    span.tag(azah.HTTP_METHOD, request.method.upper())
-                    _annotate_bytes(span, await request.read())
-                    resp, trace_str = await self._error_handle(span, request,
-                                                               handler)
-                    span.tag(azah.HTTP_STATUS_CODE, resp.status)
-                    _annotate_bytes(span, resp.body)
-                    if trace_str is not None:
-                        span.annotate(trace_str)
-                    return resp
+            # without configured tracer spans are no-op, but handlers and
+            # components still get a span with trace context
+            tracer = self.app.tracer
+            context = az.make_context(request.headers)
+            if context is None:
+                sampled = azah.parse_sampled(request.headers)
+                debug = azah.parse_debug(request.headers)
+                span = tracer.new_trace(sampled=sampled, debug=debug)
             else:
-                resp, trace_str = await self._error_handle(None, request,
+                span = tracer.join_span(context)
+            request[SPAN_KEY] = span
+
+            if span.is_noop:
+                resp, trace_str = await self._error_handle(span, request,
+                                                           handler)
+                return resp
+
+            with span:
+                span_name = '{0} {1}'.format(request.method.upper(),
+                                             request.path)
+                span.name(span_name)
+                span.kind(azah.SERVER)
+                span.tag(azah.HTTP_PATH, request.path)
+                span.tag(azah.HTTP_METHOD, request.method.upper())
+                _annotate_bytes(span, await request.read())
+                resp, trace_str = await self._error_handle(span, request,
                                                            handler)
+                span.tag(azah.HTTP_STATUS_CODE, resp.status)
+                if isinstance(resp, web.Response):
+                    _annotate_bytes(span, resp.body)
+                if trace_str is not None:
+                    span.annotate(trace_str)
                 return resp
 
-        return middleware_handler
+        if self.compression is None:
+            return middleware_handler
+
+        async def compression_handler(request: web.Request):
+            resp = await middleware_handler(request)
+            return await self.compression.compress(self.loop, request, resp)
+
+        return compression_handler
+
+    def _request_timeout(self, request: web.Request) -> Optional[float]:
+        timeout = self.request_timeout
+        value = request.headers.get(deadline.HEADER)
+        if value is not None:
+            try:
+                client_timeout = float(value)
+            except ValueError:
+                return timeout
+            if timeout is None or client_timeout < timeout:
+                timeout = client_timeout
+        return timeout
+
+    async def _call_handler(self, span, request, handler):
+        timeout = self._request_timeout(request)
+        if timeout is None:
+            return await handler(request)
+        with deadline.scope(span, timeout) as request_deadline:
+            try:
+                return await asyncio.wait_for(handler(request),
+                                              max(timeout, 0),
+                                              loop=self.loop)
+            except DeadlineExceededError:
+                pass
+            except asyncio.TimeoutError:
+                # timeout of some call made by the handler
+                if time.time() < request_deadline:
+                    raise
+        span.tag('deadline.exceeded', 'true')
+        raise web.HTTPGatewayTimeout()
 
     async def _error_handle(self, span, request, handler):
         try:
-            resp = await handler(request)
+            resp = await self._call_handler(span, request, handler)
             return resp, None
         except Exception as herr:
-            if span is not None:
-                span.tag('error', 'true')
-                span.tag('error.message', str(herr))
+            span.tag('error', 'true')
+            span.tag('error.message', str(herr))
 
             trace = None
             if self.error_handler:
@@ -131,16 +479,65 @@ class Server(Component):
 
             return resp, trace
 
-    def add_route(self, method, uri, handler):
+    def add_route(self, method, uri, handler,
+                  request_codec: Optional[RequestCodec] = None,
+                  response_codec: Optional[ResponseCodec] = None):
+        """
+        Register route handler.
+
+        Without codecs handler is called as handler(context_span, request)
+        and must return web.StreamResponse.
+        With request_codec the decoded body is passed as third argument:
+        handler(context_span, request, data).
+        With response_codec handler returns data encoded by the codec (a
+        returned web.StreamResponse is passed through as is).
+        """
+        stats = RouteStats(self, method, uri)
+        if request_codec is not None or response_codec is not None:
+            handler = partial(self._handle_codecs, handler, stats,
+                              request_codec, response_codec)
         self.web_app.router.add_route(method, uri,
-                                      partial(self._handle_request, handler))
+                                      partial(self._handle_request, handler,
+                                              stats))
+
+    async def _handle_codecs(self, handler, stats, request_codec,
+                             response_codec, context_span, request):
+        if request_codec is not None:
+            start = time.monotonic()
+            data = await request_codec.decode(context_span, request)
+            duration = (time.monotonic() - start) * 1000
+            stats.observe_codec('decode', duration)
+            context_span.tag('http.decode_ms', '%.3f' % duration)
+            res = await handler(context_span, request, data)
+        else:
+            res = await handler(context_span, request)
+
+        if response_codec is None or isinstance(res, web.StreamResponse):
+            return res
+        start = time.monotonic()
+        resp = await response_codec.encode(context_span, request, res)
+        duration = (time.monotonic() - start) * 1000
+        stats.observe_codec('encode', duration)
+        context_span.tag('http.encode_ms', '%.3f' % duration)
+        return resp
 
     def set_error_handler(self, handler):
         self.error_handler = handler
 
-    async def _handle_request(self, handler, request):
-        res = await handler(request.get(SPAN_KEY), request)
-        return res
+    async def _handle_request(self, handler, stats, request):
+        status = 500
+        stats.in_flight.inc()
+        start = time.monotonic()
+        try:
+            res = await handler(request.get(SPAN_KEY), request)
+            status = res.status
+            return res
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            stats.in_flight.dec()
+            stats.observe(status, (time.monotonic() - start) * 1000)
 
     async def prepare(self):
         self.app.log_info("Preparing to start http server")
@@ -153,10 +550,21 @@ class Server(Component):
             loop=self.loop,
             access_log=self.access_log,
             **make_handler_kwargs)
+        if self.sock is None:
+            socks = []
+        elif isinstance(self.sock, (list, tuple)):
+            socks = [_as_socket(sock) for sock in self.sock]
+        else:
+            socks = [_as_socket(self.sock)]
+        host, port = self.host, self.port
+        if self.reuse_port and port is not None:
+            socks.append(_bind_reuse_port(host, port))
+            host = port = None
         self.server_creations, self.uris = web._make_server_creators(
             self.web_app_handler,
             loop=self.loop, ssl_context=None,
-            host=self.host, port=self.port, path=None, sock=None, backlog=128)
+            host=host, port=port, path=self.path, sock=socks or None,
+            backlog=self.backlog)
 
     async def start(self):
         self.app.log_info("Starting http server")
@@ -165,6 +573,23 @@ class Server(Component):
         self.app.log_info('HTTP server ready to handle connections on %s'
                           '' % (', '.join(self.uris), ))
 
+    def handoff_env(self) -> dict:
+        """
+        Make listening sockets inheritable and return environment variables
+        for a new server process started with these descriptors
+        (e.g. subprocess.Popen(..., pass_fds=fds, env=env)). The new process
+        picks them up with http.inherited_fds() and accepts connections
+        from the same kernel queue, so none are dropped while this process
+        is stopping.
+        """
+        fds = []
+        for srv in self.servers or []:
+            for sock in srv.sockets or []:
+                fd = sock.fileno()
+                os.set_inheritable(fd, True)
+                fds.append(str(fd))
+        return {LISTEN_FDS_ENV: ','.join(fds)}
+
     async def stop(self):
         self.app.log_info("Stopping http server")
         server_closures = []
@@ -178,16 +603,59 @@ class Server(Component):
 
 
 class Client(Component):
-    # TODO make pool of clients
+
+    def __init__(self, limit: int = 100, keepalive_timeout: float = 15.,
+                 warmup_urls: Optional[List[str]] = None,
+                 warmup_connections: int = 1,
+                 warmup_timeout: float = 10.) -> None:
+        """
+        :param limit: total limit of simultaneous pooled connections
+        :param keepalive_timeout: pooled connection keep-alive timeout
+        :param warmup_urls: upstream urls pre-connected (DNS, TCP and TLS
+            handshake) during warm-up, so the first requests after start
+            reuse ready connections
+        :param warmup_connections: number of connections opened per url
+        :param warmup_timeout: warm-up request timeout
+        """
+        super(Client, self).__init__()
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+        self.warmup_urls = warmup_urls or []
+        self.warmup_connections = warmup_connections
+        self.warmup_timeout = warmup_timeout
+        self._connector: TCPConnector = None
 
     async def prepare(self):
-        pass
+        self._connector = TCPConnector(
+            limit=self.limit, keepalive_timeout=self.keepalive_timeout,
+            loop=self.loop)
+
+    async def warmup(self):
+        if not self.warmup_urls:
+            return
+        async with ClientSession(loop=self.loop, connector=self._connector,
+                                 connector_owner=False,
+                                 read_timeout=self.warmup_timeout,
+                                 conn_timeout=self.warmup_timeout) as session:
+            await asyncio.gather(*[self._warmup_url(session, url)
+                                   for url in self.warmup_urls
+                                   for _ in range(self.warmup_connections)],
+                                 loop=self.loop)
+
+    async def _warmup_url(self, session: ClientSession, url: str):
+        try:
+            async with session.head(url) as resp:
+                await resp.read()
+        except Exception as e:
+            self.app.log_warn('Could not warm up connection to %s: %s'
+                              '' % (url, e))
 
     async def start(self):
         pass
 
     async def stop(self):
-        pass
+        if self._connector is not None:
+            self._connector.close()
 
     async def post(self, context_span: azs.SpanAbc, span_params,
                    response_codec, url,
@@ -204,17 +672,32 @@ class Client(Component):
         :type conn_timeout: float
         :type ssl_ctx: ssl.SSLContext
         :rtype: Awaitable[ClientResponse]
+
+        Deadline of context_span (see aioapp.deadline) limits read_timeout
+        and is passed to the remote side in X-Request-Timeout header.
         """
-        conn = TCPConnector(ssl_context=ssl_ctx)
+        left = deadline.time_left(context_span)
+        if left is not None:
+            read_timeout = left if read_timeout is None \
+                else min(read_timeout, left)
+        if ssl_ctx is None and self._connector is not None:
+            conn = self._connector
+            conn_owner = False
+        else:
+            conn = TCPConnector(ssl_context=ssl_ctx, loop=self.loop)
+            conn_owner = True
         # TODO проверить доступные хосты для передачи трассировочных заголовков
         headers = headers or {}
-        headers.update(context_span.context.make_headers())
+        headers.update(context_span.tracer.make_headers(context_span))
+        if left is not None:
+            headers[deadline.HEADER] = '%.3f' % left
         with context_span.tracer.new_child(context_span.context) as span:
             async with ClientSession(loop=self.loop,
                                      headers=headers,
                                      read_timeout=read_timeout,
                                      conn_timeout=conn_timeout,
-                                     connector=conn) as session:
+                                     connector=conn,
+                                     connector_owner=conn_owner) as session:
                 if 'name' in span_params:
                     span.name(span_params['name'])
                 if 'endpoint_name' in span_params:
@@ -246,6 +729,10 @@ class Client(Component):
 
 
 def _annotate_bytes(span, data):
+    annotate_lazy(span, _bytes_str, data)
+
+
+def _bytes_str(data):
     if isinstance(data, BytesPayload):
         pl = io.BytesIO()
         data.write(pl)
@@ -254,4 +741,4 @@ def _annotate_bytes(span, data):
         data_str = data.decode("UTF8")
     except Exception:
         data_str = str(data)
-    span.annotate(data_str or 'null')
+    return data_str or 'null'
@@ -0,0 +1,241 @@
+import bisect
+import random
+from typing import Any, Dict, Tuple, List, Iterable, Optional  # noqa
+
+
+DEFAULT_LATENCY_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500,
+                              5000, 10000)
+
+
+class Counter:
+    __slots__ = ('name', 'tags', 'value')
+    kind = 'counter'
+
+    def __init__(self, name: str, tags: tuple) -> None:
+        self.name = name
+        self.tags = tags
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+
+class Gauge:
+    __slots__ = ('name', 'tags', 'value')
+    kind = 'gauge'
+
+    def __init__(self, name: str, tags: tuple) -> None:
+        self.name = name
+        self.tags = tags
+        self.value = 0
+
+    def inc(self, value=1):
+        self.value += value
+
+    def dec(self, value=1):
+        self.value -= value
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. Buckets are upper bounds, the last (implicit)
+    bucket collects everything above the largest bound.
+    """
+    __slots__ = ('name', 'tags', 'bounds', 'counts', 'count', 'sum')
+    kind = 'histogram'
+
+    def __init__(self, name: str, tags: tuple,
+                 bounds: Iterable = DEFAULT_LATENCY_BUCKETS_MS) -> None:
+        self.name = name
+        self.tags = tags
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def buckets(self) -> List[Tuple[str, int]]:
+        """
+        Cumulative bucket counts as a list of (upper bound, count)
+        """
+        res = []
+        total = 0
+        for i, bound in enumerate(self.bounds):
+            total += self.counts[i]
+            res.append((str(bound), total))
+        res.append(('inf', self.count))
+        return res
+
+    def quantile(self, q: float):
+        """
+        Upper bound of the bucket containing the q-th quantile
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        total = 0
+        for i, bound in enumerate(self.bounds):
+            total += self.counts[i]
+            if total >= rank:
+                return bound
+        return float('inf')
+
+
+class Summary:
+    """
+    Summary of values observed during a flush interval: count, sum, min,
+    max and percentiles. Percentiles are computed from a uniform sample of
+    at most max_samples values, so memory does not depend on traffic.
+    """
+    __slots__ = ('max_samples', 'count', 'sum', 'min', 'max', 'samples')
+
+    def __init__(self, max_samples: int = 1024) -> None:
+        self.max_samples = max_samples
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+        self.samples: List[float] = []
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.samples) < self.max_samples:
+            self.samples.append(value)
+        else:
+            # reservoir sampling
+            i = random.randrange(self.count)  # nosec
+            if i < self.max_samples:
+                self.samples[i] = value
+
+    def percentiles(self, qs: Iterable[float]) -> List[float]:
+        """
+        Nearest-rank percentiles, qs are in range 0-100
+        """
+        if not self.samples:
+            return [None for _ in qs]
+        samples = sorted(self.samples)
+        res = []
+        for q in qs:
+            rank = int(round(q / 100. * len(samples)))
+            res.append(samples[min(len(samples), max(1, rank)) - 1])
+        return res
+
+
+def _make_tags(tags: Optional[dict]) -> tuple:
+    if not tags:
+        return ()
+    return tuple(sorted((k, str(v)) for k, v in tags.items()))
+
+
+class Registry:
+    """
+    In-process metrics storage. Metrics are identified by name and tags and
+    are independent of tracing, so they cover every request regardless of
+    the tracer sample rate.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: Dict[Tuple[str, tuple], Any] = {}
+        self._sent: Dict[Tuple[str, tuple], float] = {}
+        self._collectors: List[Any] = []
+
+    def add_collector(self, callback) -> None:
+        """
+        Register callback() that refreshes gauges from external state right
+        before metrics are collected or sent
+        """
+        self._collectors.append(callback)
+
+    def _run_collectors(self):
+        for callback in self._collectors:
+            callback()
+
+    def _get(self, cls, name, tags, *args):
+        key = (name, _make_tags(tags))
+        metric = self._metrics.get(key)
+        if metric is None:
+            metric = cls(key[0], key[1], *args)
+            self._metrics[key] = metric
+        elif not isinstance(metric, cls):
+            raise UserWarning('Metric %s is already registered as %s'
+                              '' % (name, metric.kind))
+        return metric
+
+    def counter(self, name: str, tags: dict = None) -> Counter:
+        return self._get(Counter, name, tags)
+
+    def gauge(self, name: str, tags: dict = None) -> Gauge:
+        return self._get(Gauge, name, tags)
+
+    def histogram(self, name: str, tags: dict = None,
+                  bounds: Iterable = DEFAULT_LATENCY_BUCKETS_MS
+                  ) -> Histogram:
+        return self._get(Histogram, name, tags, bounds)
+
+    def collect(self) -> list:
+        """
+        Snapshot of all metrics as a list of dicts
+        """
+        self._run_collectors()
+        res = []
+        for metric in self._metrics.values():
+            rec = {
+                'name': metric.name,
+                'tags': dict(metric.tags),
+                'kind': metric.kind,
+            }
+            if isinstance(metric, Histogram):
+                rec['count'] = metric.count
+                rec['sum'] = metric.sum
+                rec['buckets'] = metric.buckets()
+            else:
+                rec['value'] = metric.value
+            res.append(rec)
+        return res
+
+    def send_to_statsd(self, client, prefix, render_name):
+        """
+        Flush metrics to statsd client. Counters and histogram buckets are
+        sent as counter deltas since the previous flush, gauges as is.
+
+        :type client: aiostatsd.client.StatsdClient
+        :type prefix: str
+        :param render_name: callable(name, tags) -> str
+        """
+        self._run_collectors()
+        for metric in list(self._metrics.values()):
+            if isinstance(metric, Gauge):
+                client.send_gauge(render_name(prefix + metric.name,
+                                              metric.tags),
+                                  metric.value)
+            elif isinstance(metric, Counter):
+                self._send_delta(client, render_name, prefix + metric.name,
+                                 metric.tags, metric.value)
+            elif isinstance(metric, Histogram):
+                name = prefix + metric.name
+                self._send_delta(client, render_name, name + '_count',
+                                 metric.tags, metric.count)
+                self._send_delta(client, render_name, name + '_sum',
+                                 metric.tags, metric.sum)
+                for bound, cnt in metric.buckets():
+                    self._send_delta(client, render_name, name + '_bucket',
+                                     metric.tags + (('le', bound),), cnt)
+
+    def _send_delta(self, client, render_name, name, tags, value):
+        key = (name, tags)
+        delta = value - self._sent.get(key, 0)
+        self._sent[key] = value
+        if delta:
+            client.send_counter(render_name(name, tags), delta)
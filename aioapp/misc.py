@@ -12,6 +12,11 @@ from functools import partial
 from urllib.parse import urlunsplit, urlsplit
 from yarl import URL
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 
 def async_call(loop, func, *args, delay=None, **kwargs):
     """
@@ -117,6 +122,38 @@ def json_encode(data):
     return json.dumps(data, default=_json_encoder)
 
 
+def json_dumps_bytes(data, default=_json_encoder):
+    """
+    Serialize data to UTF-8 JSON bytes using the fastest available backend
+    (orjson if installed, stdlib json otherwise). Data orjson can't
+    serialize (e.g. ints wider than 64 bits) is serialized with stdlib
+    json, so the result doesn't depend on the installed backend.
+
+    :param default: called for objects JSON can't serialize, with None
+        such objects raise TypeError
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data, default=default,
+                                option=orjson.OPT_PASSTHROUGH_DATETIME |
+                                orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass
+    return json.dumps(data, default=default).encode('UTF-8')
+
+
+def json_loads(data):
+    """
+    Deserialize JSON from str, bytes or memoryview using the fastest
+    available backend
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
 def parse_dsn(dsn, default_port=5432, protocol='http://'):
     """
     Разбирает строку подключения к БД и возвращает список из (host, port,
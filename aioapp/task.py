@@ -11,7 +11,9 @@ from typing import List
 from .app import Component
 from .misc import mask_url_pwd, async_call, get_func_params
 from .error import (PrepareError, TaskFormatError, UnknownTaskError,
-                    BadTaskParamsError)
+                    BadTaskParamsError, DeadlineExceededError)
+from .tracer import annotate_lazy
+from . import deadline
 import aiozipkin.aiohttp_helpers as azah  # noqa
 import aiozipkin.helpers as azh  # noqa
 import aiozipkin.span as azs  # noqa
@@ -196,8 +198,8 @@ class TaskManager(Component):
         :type envelope: Envelope
         :type properties: Properties
         """
-        context_span: azs.SpanAbc = self.app._tracer.new_trace(sampled=True,
-                                                               debug=False)
+        context_span: azs.SpanAbc = self.app.tracer.new_trace(sampled=True,
+                                                              debug=False)
 
         context_span.name('amqp:message')
         context_span.kind(azh.SERVER)
@@ -216,13 +218,13 @@ class TaskManager(Component):
                         context_span.tag('acknowledged', 'true')
                         try:
                             task = Task.load(self, body, context_span)
-                            await task.run(**task.params)
+                            await task.run_until_deadline()
                         except Exception as e:
                             self.app.log_err(e)
                 except Exception as err:
                     context_span.tag('error', 'true')
                     context_span.tag('error.message', err)
-                    context_span.annotate(traceback.format_exc())
+                    annotate_lazy(context_span, traceback.format_exc)
         async_call(self.loop, _amsg, context_span, channel, body, envelope,
                    properties)
 
@@ -237,15 +239,18 @@ class TaskManager(Component):
                                              routing_key, properties,
                                              mandatory, immediate)
 
-    async def run(self, context_span, name, params, delay=None):
+    async def run(self, context_span, name, params, delay=None,
+                  carry_deadline=False):
         """
         :type context_span: azs.SpanAbc
         :type name: str
         :type delay: datetime.timedelta
         :type params: dict
+        :param carry_deadline: see Task.schedule
         """
         task = Task(self, name, params, attempt=1)
-        await task.schedule(context_span, delay)
+        await task.schedule(context_span, delay,
+                            carry_deadline=carry_deadline)
 
     async def _con_error(self, error):
         if self._shutting_down:
@@ -282,6 +287,7 @@ class Task:
         """
         self.body = None
         self.context_span = None  # type: azs.SpanAbc
+        self.deadline = None  # type: float
         self.tm = tm
         self.app = tm.app
         self.attempt = attempt
@@ -310,7 +316,8 @@ class Task:
         :type context_span: azs.SpanAbc
         :return:
         """
-        name, params, attempt = Task.decode(context_span, body)
+        name, params, attempt, task_deadline = Task._decode(context_span,
+                                                            body)
         tasks = tm.handler._tasks()
         task_cls = tasks.get(name)
         if task_cls is None:
@@ -319,6 +326,7 @@ class Task:
         task = task_cls(tm, name, params, attempt=attempt)
         task.body = body
         task.context_span = context_span
+        task.deadline = task_deadline
         return task
 
     @staticmethod
@@ -326,7 +334,16 @@ class Task:
         """
         :type context_span: azs.SpanAbc
         :type body: bytes
-        :return:
+        :return: name, params, attempt
+        """
+        name, params, attempt, _ = Task._decode(context_span, body)
+        return name, params, attempt
+
+    @staticmethod
+    def _decode(context_span, body):
+        """
+        Same as decode, the deadline of the task (or None) is returned as
+        the fourth item
         """
         try:
             data = json.loads(body.decode("UTF-8"))
@@ -335,32 +352,47 @@ class Task:
         if not isinstance(data, dict):
             raise TaskFormatError("Bad task format: %s" % str(body))
         name = data.get("name")
-        context_span.tag('subscr.task_name', name)
-        context_span.name('task:%s' % name)
         params = data.get("params")
-        context_span.annotate(repr(params))
         attempt = int(data.get("attempt") or 1)
+        task_deadline = data.get("deadline")
+        if task_deadline is not None:
+            task_deadline = float(task_deadline)
+        context_span.tag('subscr.task_name', name)
+        context_span.name('task:%s' % name)
+        annotate_lazy(context_span, repr, params)
         context_span.tag('subscr.task_attempt', str(attempt))
+        if task_deadline is not None:
+            context_span.tag('subscr.task_deadline', str(task_deadline))
         if name is None or not isinstance(name, str):
             raise UnknownTaskError("Unknown task")
         if params is not None and not isinstance(params, dict):
             raise BadTaskParamsError("Bad task parameters")
-        return name, params, attempt
+        return name, params, attempt, task_deadline
 
     @staticmethod
-    def encode(name, params, attempt=1):
+    def encode(name, params, attempt=1, deadline=None):
+        """
+        :param deadline: absolute unix time after which the task is dropped
+        """
         req = {
             "name": name,
             "params": params,
             "attempt": attempt,
         }
+        if deadline is not None:
+            req["deadline"] = deadline
         return json.dumps(req).encode("UTF8")
 
-    async def schedule(self, context_span, delay=None):
+    async def schedule(self, context_span, delay=None, carry_deadline=False):
         """
         :type context_span: azs.SpanAbc
         :type delay: datetime.timedelta
+        :param carry_deadline: carry the deadline of context_span (see
+            aioapp.deadline) in the task message, the task is dropped if it
+            is delivered after the deadline. Can not be used with delay.
         """
+        if carry_deadline and delay is not None:
+            raise UserWarning('Deadline can not be carried by delayed task')
         properties = {"delivery_mode": 2}
         if delay is not None:
             if not isinstance(delay, timedelta):
@@ -371,13 +403,16 @@ class Task:
         else:
             queue = self.tm.queue
         with context_span.tracer.new_child(context_span.context) as span:
+            payload = Task.encode(
+                self.name, self.params,
+                deadline=deadline.get(context_span) if carry_deadline
+                else None)
             span.name('schedule:' + self.name)
             span.tag('subscr.task_name', self.name)
             span.tag('amqp:queue', queue)
             span.tag('amqp:expiration', properties.get('expiration', 'null'))
             span.tag('amqp:delivery_mode',
                      properties.get('delivery_mode', 'null'))
-            payload = Task.encode(self.name, self.params)
             _annotate_bytes(span, payload)
             await self.tm._send_message(
                 span,
@@ -386,6 +421,24 @@ class Task:
                 queue,
                 properties)
 
+    async def run_until_deadline(self):
+        """
+        Run the task within its deadline. Expired task is dropped, running
+        one is cancelled when the deadline is exceeded.
+        """
+        if self.deadline is None:
+            return await self.run(**self.params)
+        with deadline.scope(self.context_span, deadline=self.deadline):
+            try:
+                left = deadline.time_left(self.context_span)
+                return await asyncio.wait_for(self.run(**self.params), left,
+                                              loop=self.app.loop)
+            except (DeadlineExceededError, asyncio.TimeoutError):
+                if time.time() < self.deadline:
+                    raise
+                self.context_span.tag('deadline.exceeded', 'true')
+                self.app.log_warn('%s dropped: deadline exceeded' % self)
+
     async def run(self, **kwargs):  # type: ignore
         raise NotImplementedError()
 
@@ -395,8 +448,12 @@ class TaskRetry(Exception):
 
 
 def _annotate_bytes(span, data):
+    annotate_lazy(span, _bytes_str, data)
+
+
+def _bytes_str(data):
     try:
         data_str = data.decode("UTF8")
     except Exception:
         data_str = str(data)
-    span.annotate(data_str or 'null')
+    return data_str or 'null'
@@ -1,21 +1,281 @@
 import re
 import asyncio
+import zlib
+import itertools
+from collections import OrderedDict, deque
+from typing import Dict, Tuple, List  # noqa
 import aiozipkin.tracer as azt
+import aiozipkin.span as azs
+from aiozipkin.helpers import TraceContext, SAMPLED_ID_HEADER
 from aiostatsd.client import StatsdClient
 import aiozipkin.constants as azc
+from .metrics import Summary
 
 STATS_CLEAN_NAME_RE = re.compile('[^0-9a-zA-Z_.-]')
 STATS_CLEAN_TAG_RE = re.compile('[^0-9a-zA-Z_=.-]')
 
+NOOP_HEADERS = {SAMPLED_ID_HEADER: '0'}
+
+DROP_POLICIES = ('oldest', 'newest', 'unsampled_first')
+
+# span tag -> metric tag copied to http metrics
+HTTP_METRIC_TAGS = (
+    (azc.HTTP_STATUS_CODE, 'status'),
+    (azc.HTTP_METHOD, 'method'),
+    (azc.HTTP_HOST, 'host'),
+    ('api.key', 'api_key'),
+    ('api.method', 'api_method'),
+    ('api.code', 'api_code'),
+    ('api_merc.code', 'api_merc_code'),
+)
+# span name prefix -> metric name, the rest of span name is kind tag
+SPAN_NAME_METRICS = (
+    ('db:', 'db'),
+    ('redis:', 'redis'),
+)
+
+
+def stats_metric_name(name, tags):
+    """
+    Render statsd metric name with tags, e.g. "prefix_http,kind=in,status=200"
+
+    :type name: str
+    :type tags: list of (tag name, tag value) tuples
+    """
+    name = name.replace(' ', '_').replace(':', '_')
+    name = STATS_CLEAN_NAME_RE.sub('', name)
+    for tag_name, tag_val in tags:
+        t = str(tag_val).replace(':', '-')
+        t = STATS_CLEAN_TAG_RE.sub('', t)
+        name += ',' + tag_name + "=" + t
+    return name
+
 
 class Tracer(azt.Tracer):
+    def __init__(self, transport, sampler, local_endpoint,
+                 tail_sampling: bool = False) -> None:
+        """
+        :param tail_sampling: every trace is recorded regardless of the
+            sampling flag of the client and the sampling decision is not
+            passed downstream, traces are sampled by the transport (see
+            TailSampler)
+        """
+        super(Tracer, self).__init__(transport, sampler, local_endpoint)
+        self.tail_sampling = tail_sampling
+
+    def new_trace(self, sampled=None, debug=False) -> azs.SpanAbc:
+        if self.tail_sampling:
+            sampled = True
+        return super(Tracer, self).new_trace(sampled=sampled, debug=debug)
+
+    def join_span(self, context: TraceContext) -> azs.SpanAbc:
+        if self.tail_sampling:
+            context = context._replace(sampled=True)
+        return super(Tracer, self).join_span(context)
+
+    def make_headers(self, span: azs.SpanAbc) -> Dict[str, str]:
+        """
+        B3 headers passing trace of span downstream
+        """
+        if span.is_noop:
+            return dict(NOOP_HEADERS)
+        headers = span.context.make_headers()
+        if self.tail_sampling:
+            # without the flag downstream services decide themselves,
+            # in tail mode they record the trace and keep it by the same
+            # trace_sampled decision
+            headers.pop(SAMPLED_ID_HEADER, None)
+        return headers
+
+    def new_child(self, context: TraceContext) -> azs.SpanAbc:
+        if not context.sampled:
+            # children of unsampled trace are never recorded, so they share
+            # the parent context instead of generating new span ids
+            return azs.NoopSpan(self, context)
+        return super(Tracer, self).new_child(context)
+
     async def stop(self):
         await self.close()
 
 
+class NoopTracer:
+    """
+    Tracer used when tracing is not configured. All spans are no-op, but
+    every trace gets its own (process-unique) trace id, so trace scoped
+    state (e.g. aioapp.deadline) keeps working.
+    """
+
+    def __init__(self) -> None:
+        self._ids = itertools.count(1)
+
+    def new_trace(self, sampled=None, debug=False) -> azs.SpanAbc:
+        context = TraceContext(trace_id=format(next(self._ids), '032x'),
+                               parent_id=None, span_id='0' * 16,
+                               sampled=False, debug=False, shared=False)
+        return azs.NoopSpan(self, context)
+
+    def join_span(self, context: TraceContext) -> azs.SpanAbc:
+        return azs.NoopSpan(self, context._replace(sampled=False))
+
+    def new_child(self, context: TraceContext) -> azs.SpanAbc:
+        return azs.NoopSpan(self, context)
+
+    def to_span(self, context: TraceContext) -> azs.SpanAbc:
+        return azs.NoopSpan(self, context)
+
+    def make_headers(self, span: azs.SpanAbc) -> Dict[str, str]:
+        # ids of no-op spans are process-local, only the sampling decision
+        # is passed downstream
+        return dict(NOOP_HEADERS)
+
+    async def close(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+NOOP_TRACER = NoopTracer()
+
+
+def annotate_lazy(span: azs.SpanAbc, func, *args) -> None:
+    """
+    Annotate span with func(*args). The value is not computed for no-op
+    spans (unsampled traces, no tracer), so expensive annotations (repr of
+    query arguments, bodies, tracebacks) cost nothing there. Other span
+    methods of no-op spans are cheap and need no guards.
+    """
+    if not span.is_noop:
+        span.annotate(func(*args))
+
+
+class _TailTrace:
+    __slots__ = ('spans', 'size', 'last_seen', 'reason')
+
+    def __init__(self) -> None:
+        self.spans: List[dict] = []
+        self.size = 0
+        self.last_seen = 0.
+        # reason to keep the trace regardless of sample rate
+        self.reason = None
+
+
+class TailSampler:
+    """
+    Tail-based sampling: spans of every trace are buffered until no new
+    spans of the trace were seen for window seconds, then the whole trace
+    is kept if it has a debug or error span, a span slower than latency_ms
+    or if it is hit by sample_rate (see trace_sampled), and dropped
+    otherwise.
+
+    Spans which arrive after the decision follow it. When the buffer is
+    over max_traces or max_bytes, the oldest traces are decided early.
+    """
+
+    def __init__(self, app, send, sample_rate: float, window: float,
+                 latency_ms: float, max_traces: int, max_bytes: int) -> None:
+        """
+        :param send: callable(span record) called for spans of kept traces
+        """
+        self.app = app
+        self._send = send
+        self._sample_rate = sample_rate
+        self._window = window
+        self._latency_us = latency_ms * 1000
+        self._max_traces = max_traces
+        self._max_bytes = max_bytes
+        # trace id -> trace, least recently seen first
+        self._traces: OrderedDict = OrderedDict()
+        self._size = 0
+        # trace id -> decision, for spans arriving after the decision
+        self._decided: OrderedDict = OrderedDict()
+
+        metrics = app._metrics
+        self._kept_metrics = {
+            reason: metrics.counter('tracer_tail_traces',
+                                    {'decision': 'kept', 'reason': reason})
+            for reason in ('debug', 'error', 'slow', 'rate')
+        }
+        self._dropped_metric = metrics.counter('tracer_tail_traces',
+                                               {'decision': 'dropped'})
+        self._early_metric = metrics.counter('tracer_tail_early_decisions')
+        self._traces_metric = metrics.gauge('tracer_tail_buffer_traces')
+        self._bytes_metric = metrics.gauge('tracer_tail_buffer_bytes')
+        metrics.add_collector(self._collect_metrics)
+
+    def add(self, data: dict, now: float) -> None:
+        trace_id = data['traceId']
+        decision = self._decided.get(trace_id)
+        if decision is not None:
+            if decision:
+                self._send(data)
+            return
+
+        trace = self._traces.get(trace_id)
+        if trace is None:
+            trace = self._traces[trace_id] = _TailTrace()
+        else:
+            self._traces.move_to_end(trace_id)
+        size = _approx_span_size(data)
+        trace.spans.append(data)
+        trace.size += size
+        trace.last_seen = now
+        self._size += size
+        if trace.reason is None:
+            if data.get('debug'):
+                trace.reason = 'debug'
+            elif azc.ERROR in data['tags']:
+                trace.reason = 'error'
+            elif data.get('duration', 0) >= self._latency_us:
+                trace.reason = 'slow'
+
+        while self._traces and (len(self._traces) > self._max_traces or
+                                self._size > self._max_bytes):
+            self._early_metric.inc()
+            self._decide(*self._traces.popitem(last=False))
+
+    def flush(self, now: float, force: bool = False) -> None:
+        """
+        Decide traces which were idle for the window (or all traces)
+        """
+        traces = self._traces
+        while traces:
+            trace_id, trace = next(iter(traces.items()))
+            if not force and now - trace.last_seen < self._window:
+                break
+            del traces[trace_id]
+            self._decide(trace_id, trace)
+
+    def _decide(self, trace_id: str, trace: _TailTrace) -> None:
+        self._size -= trace.size
+        reason = trace.reason
+        if reason is None and trace_sampled(trace_id, self._sample_rate):
+            reason = 'rate'
+        keep = reason is not None
+        if keep:
+            self._kept_metrics[reason].inc()
+            for data in trace.spans:
+                self._send(data)
+        else:
+            self._dropped_metric.inc()
+        self._decided[trace_id] = keep
+        if len(self._decided) > self._max_traces:
+            self._decided.popitem(last=False)
+
+    def _collect_metrics(self):
+        self._traces_metric.set(len(self._traces))
+        self._bytes_metric.set(self._size)
+
+
 class TracerTransport(azt.Transport):
     def __init__(self, app, driver, addr, metrics_diver, metrics_addr,
-                 metrics_name, send_inteval, loop):
+                 metrics_name, send_inteval, loop, metrics_aggregate=False,
+                 metrics_percentiles=(50, 95, 99),
+                 metrics_name_cache_size=1024, max_queue_spans=10000,
+                 max_queue_bytes=16 * 1024 * 1024, drop_policy='oldest',
+                 max_send_backoff=60., tail_sample_rate=None,
+                 tail_window=5., tail_latency_ms=1000.,
+                 tail_max_traces=10000, tail_max_bytes=32 * 1024 * 1024):
         """
         :type tracer: str
         :type tracer_url: str
@@ -23,9 +283,39 @@ class TracerTransport(azt.Transport):
         :type statsd_prefix: str
         :type send_inteval: float
         :type loop: asyncio.AbstractEventLoop
+        :param metrics_aggregate: fold span durations into per-metric
+            summaries and send one summary per metric per flush (count and
+            sum counters, min, max and percentile gauges) instead of a timer
+            per span
+        :param metrics_percentiles: percentiles of aggregated summaries
+        :param metrics_name_cache_size: size of LRU cache of rendered metric
+            names keyed by span name, kind and metric tags
+        :param max_queue_spans: max number of spans waiting to be sent to
+            zipkin
+        :param max_queue_bytes: max approximate size of spans waiting to be
+            sent to zipkin
+        :param drop_policy: which span to drop when the queue is full:
+            'oldest', 'newest' or 'unsampled_first' (spans which are queued
+            only because of the sample rate, i.e. neither debug nor error
+            spans, are dropped first, oldest of them first). Drops are O(1)
+            with every policy.
+        :param max_send_backoff: max delay (seconds) between retries of
+            failed sends, the delay doubles on every failure starting from
+            send_inteval
+        :param tail_sample_rate: enables tail-based sampling of spans sent
+            to zipkin (see TailSampler), the rate of traces kept without
+            errors or slow spans. Head sampling must record every trace
+            for it to work.
+        :param tail_window: seconds without new spans after which a trace
+            is decided
+        :param tail_latency_ms: traces with a slower span are kept
+        :param tail_max_traces: max number of traces buffered
+        :param tail_max_bytes: max approximate size of spans buffered
         """
         if driver is not None and driver != 'zipkin':
             raise UserWarning('Unsupported tracer driver')
+        if drop_policy not in DROP_POLICIES:
+            raise UserWarning('Unsupported drop policy %s' % drop_policy)
         if metrics_diver is not None and metrics_diver != 'statsd':
             raise UserWarning('Unsupported metrics driver')
 
@@ -39,16 +329,74 @@ class TracerTransport(azt.Transport):
         self._metrics_diver = metrics_diver
         self._metrics_addr = metrics_addr
         self._metrics_name = metrics_name
+        self._metrics_aggregate = metrics_aggregate
+        self._metrics_percentiles = tuple(metrics_percentiles)
+        self._metrics_name_cache_size = metrics_name_cache_size
+        # metric key -> (name, tags, rendered name)
+        self._metrics_names: OrderedDict = OrderedDict()
+
+        # spans waiting for zipkin and (approximate) size of them. With
+        # 'unsampled_first' policy debug and error spans are queued
+        # separately, so a span to drop is always at the head of a queue.
+        self._queue: deque = deque()
+        self._queue_kept: deque = deque()
+        self._queue_bytes = 0
+        # spans waiting for statsd
+        self._stats_queue: List[dict] = []
+        self._max_queue_spans = max_queue_spans
+        self._max_queue_bytes = max_queue_bytes
+        self._drop_policy = drop_policy
+        self._max_send_backoff = max_send_backoff
+        self._send_backoff = 0.
+        self._send_retry_at = 0.
+
+        metrics = app._metrics
+        self._dropped_metrics = {
+            reason: metrics.counter('tracer_spans_dropped',
+                                    {'reason': reason})
+            for reason in ('spans', 'bytes')
+        }
+        self._send_errors_metric = metrics.counter('tracer_send_errors')
+        self._queue_spans_metric = metrics.gauge('tracer_queue_spans')
+        self._queue_bytes_metric = metrics.gauge('tracer_queue_bytes')
+        metrics.add_collector(self._collect_queue_metrics)
+
+        self._tail_sampler = None
+        if tail_sample_rate is not None:
+            self._tail_sampler = TailSampler(
+                app, self._enqueue, tail_sample_rate, tail_window,
+                tail_latency_ms, tail_max_traces, tail_max_bytes)
 
         self.stats = None
+        self._metrics_task = None
         if metrics_diver == 'statsd':
             addr = metrics_addr.split(':')
             host = addr[0]
             port = int(addr[1]) if len(addr) > 1 else 8125
             self.stats = StatsdClient(host, port)
             asyncio.ensure_future(self.stats.run(), loop=loop)
+            self._metrics_task = asyncio.ensure_future(
+                self._metrics_sender_loop(send_inteval), loop=loop)
+
+    async def _metrics_sender_loop(self, send_inteval):
+        # app metrics are flushed independently of spans, so they are sent
+        # even if nothing was sampled
+        while True:
+            await asyncio.sleep(send_inteval, loop=self.loop)
+            self._send_app_metrics()
+
+    def _send_app_metrics(self):
+        try:
+            self.app._metrics.send_to_statsd(self.stats,
+                                             self._metrics_name or '',
+                                             stats_metric_name)
+        except Exception as e:
+            self.app.log_err(e)
 
     async def close(self):
+        if self._metrics_task:
+            self._metrics_task.cancel()
+            self._send_app_metrics()
         if self.stats:
             try:
                 await asyncio.sleep(.001, loop=self.loop)
@@ -57,68 +405,205 @@ class TracerTransport(azt.Transport):
                 self.app.log_err(e)
         await super(TracerTransport, self).close()
 
-    async def _send(self):
-        data = self._queue[:]
+    def send(self, record):
+        data = record.asdict()
+        if self.stats:
+            self._stats_queue.append(data)
+        if self._driver != 'zipkin':
+            return
+        if self._tail_sampler is not None:
+            self._tail_sampler.add(data, self.loop.time())
+        else:
+            self._enqueue(data)
+
+    def _enqueue(self, data):
+        if self._drop_policy == 'unsampled_first' and \
+                (data.get('debug') or azc.ERROR in data['tags']):
+            self._queue_kept.append(data)
+        else:
+            self._queue.append(data)
+        self._queue_bytes += _approx_span_size(data)
+        self._limit_queue()
+
+    def _limit_queue(self):
+        while True:
+            if len(self._queue) + len(self._queue_kept) > \
+                    self._max_queue_spans:
+                reason = 'spans'
+            elif self._queue_bytes > self._max_queue_bytes:
+                reason = 'bytes'
+            else:
+                break
+            queue = self._queue or self._queue_kept
+            if not queue:
+                break
+            if self._drop_policy == 'newest':
+                data = queue.pop()
+            else:
+                data = queue.popleft()
+            self._queue_bytes -= _approx_span_size(data)
+            self._dropped_metrics[reason].inc()
 
+    def _collect_queue_metrics(self):
+        self._queue_spans_metric.set(len(self._queue) +
+                                     len(self._queue_kept))
+        self._queue_bytes_metric.set(self._queue_bytes)
+
+    async def _sender_loop(self):
+        # unlike aiozipkin, the queue is checked in _send, because spans
+        # for statsd are queued separately
+        while not self._ender.done():
+            await self._send()
+            await self._wait()
+
+    async def _send(self):
+        data, self._stats_queue = self._stats_queue, []
         try:
-            if self.stats:
+            if data and self.stats:
                 await self._send_to_statsd(data)
         except Exception as e:
             self.app.log_err(e)
 
+        if self._tail_sampler is not None:
+            self._tail_sampler.flush(self.loop.time(), force=self._closing)
+        if self._driver != 'zipkin' or \
+                not (self._queue or self._queue_kept):
+            return
+        if not self._closing and self.loop.time() < self._send_retry_at:
+            return
+
+        queues = (self._queue, self._queue_kept)
+        self._queue, self._queue_kept = deque(), deque()
+        data_bytes, self._queue_bytes = self._queue_bytes, 0
         try:
-            if self._driver == 'zipkin':
-                # TODO отправить pull request в aiozipkin: не отправлять
-                # TODO запрос, если self._queue пуста
-                await super(TracerTransport, self)._send()
-            else:
-                self._queue = []
+            await self._post_spans(list(itertools.chain(*queues)))
         except Exception as e:
+            self._send_errors_metric.inc()
+            self._send_backoff = min(
+                self._max_send_backoff,
+                max(self._send_interval, self._send_backoff * 2))
+            self._send_retry_at = self.loop.time() + self._send_backoff
             self.app.log_err(e)
+            # put failed spans back before ones queued while sending
+            queues[0].extend(self._queue)
+            queues[1].extend(self._queue_kept)
+            self._queue, self._queue_kept = queues
+            self._queue_bytes += data_bytes
+            self._limit_queue()
+        else:
+            self._send_backoff = 0.
+            self._send_retry_at = 0.
+
+    async def _post_spans(self, data):
+        headers = {'Content-Type': 'application/json'}
+        async with self._session.post(self._address, json=data,
+                                      headers=headers) as resp:
+            body = await resp.text()
+            if resp.status >= 300:
+                raise RuntimeError('zipkin responded with code: %s and '
+                                   'body: %s' % (resp.status, body))
 
     async def _send_to_statsd(self, data):
-        if self.stats:
+        if not self.stats:
+            return
+        if not self._metrics_aggregate:
             for rec in data:
-                tags = []
-                t = rec['tags']
-                if azc.HTTP_PATH in t and 'kind' in rec:
-                    name = 'http'
-                    if rec["kind"] == 'SERVER':
-                        tags.append(('kind', 'in'))
-                    else:
-                        tags.append(('kind', 'out'))
-
-                    copy_tags = {
-                        azc.HTTP_STATUS_CODE: 'status',
-                        azc.HTTP_METHOD: 'method',
-                        azc.HTTP_HOST: 'host',
-                        'api.key': 'api_key',
-                        'api.method': 'api_method',
-                        'api.code': 'api_code',
-                        'api_merc.code': 'api_merc_code',
-                    }
-                    for tag_key, tag_name in copy_tags.items():
-                        if tag_key in t:
-                            tags.append((tag_name, t[tag_key]))
-
-                elif rec['name'].startswith('db:'):
-                    name = 'db'
-                    tags.append(('kind', rec['name'][len('db:'):]))
-                elif rec['name'].startswith('redis:'):
-                    name = 'redis'
-                    tags.append(('kind', rec['name'][len('redis:'):]))
-                else:
-                    name = rec['name']
-
-                name = name.replace(' ', '_').replace(':', '_')
-                name = self._metrics_name + name
-                name = STATS_CLEAN_NAME_RE.sub('', name)
-
-                if len(tags) > 0:
-                    for tag in tags:
-                        t = tag[1].replace(':', '-')
-                        t = STATS_CLEAN_TAG_RE.sub('', t)
-                        name += ',' + tag[0] + "=" + t
-                self.stats.send_timer(name,
+                self.stats.send_timer(self._span_metric(rec)[2],
                                       int(round(rec["duration"] / 1000)),
                                       rate=1.0)
+            return
+
+        summaries: Dict[tuple, Summary] = {}
+        for rec in data:
+            key = _span_metric_key(rec)
+            summary = summaries.get(key)
+            if summary is None:
+                summary = summaries[key] = Summary()
+            summary.observe(rec["duration"] / 1000)
+        for key, summary in summaries.items():
+            name, tags, _ = self._metric_name(key)
+            self._send_summary(name, tags, summary)
+
+    def _send_summary(self, name, tags, summary):
+        stats = self.stats
+        stats.send_counter(stats_metric_name(name + '_count', tags),
+                           summary.count)
+        stats.send_counter(stats_metric_name(name + '_sum', tags),
+                           int(round(summary.sum)))
+        stats.send_gauge(stats_metric_name(name + '_min', tags),
+                         int(round(summary.min)))
+        stats.send_gauge(stats_metric_name(name + '_max', tags),
+                         int(round(summary.max)))
+        for q, value in zip(self._metrics_percentiles,
+                            summary.percentiles(self._metrics_percentiles)):
+            stats.send_gauge(stats_metric_name('%s_p%s' % (name, q), tags),
+                             int(round(value)))
+
+    def _span_metric(self, rec) -> Tuple[str, tuple, str]:
+        """
+        Metric name (with prefix), tags and rendered name of span record
+        """
+        return self._metric_name(_span_metric_key(rec))
+
+    def _metric_name(self, key: tuple) -> Tuple[str, tuple, str]:
+        cache = self._metrics_names
+        res = cache.get(key)
+        if res is not None:
+            cache.move_to_end(key)
+            return res
+        name, tags = _metric_from_key(key)
+        name = (self._metrics_name or '') + name
+        res = (name, tags, stats_metric_name(name, tags))
+        cache[key] = res
+        if len(cache) > self._metrics_name_cache_size:
+            cache.popitem(last=False)
+        return res
+
+
+def trace_sampled(trace_id: str, rate: float) -> bool:
+    """
+    Sampling decision derived from trace id, so every service of the trace
+    makes the same decision
+    """
+    try:
+        value = int(trace_id[-16:], 16)
+    except ValueError:
+        value = zlib.crc32(trace_id.encode()) << 32
+    return value < rate * 2 ** 64
+
+
+def _approx_span_size(data) -> int:
+    """
+    Cheap estimate of JSON size of span record
+    """
+    size = 256 + len(data['name'])
+    for key, value in data['tags'].items():
+        size += len(key) + len(value) + 8
+    for annotation in data['annotations']:
+        size += len(annotation['value']) + 32
+    return size
+
+
+def _span_metric_key(rec) -> tuple:
+    """
+    Hashable key of the span record fields the metric depends on
+    """
+    t = rec['tags']
+    if azc.HTTP_PATH in t and 'kind' in rec:
+        return ('http', rec['kind'] == 'SERVER',
+                tuple(t.get(tag_key) for tag_key, _ in HTTP_METRIC_TAGS))
+    return (rec['name'],)
+
+
+def _metric_from_key(key: tuple) -> Tuple[str, tuple]:
+    if key[0] == 'http' and len(key) == 3:
+        tags = [('kind', 'in' if key[1] else 'out')]
+        for (_, tag_name), value in zip(HTTP_METRIC_TAGS, key[2]):
+            if value is not None:
+                tags.append((tag_name, value))
+        return 'http', tuple(tags)
+    span_name = key[0]
+    for prefix, name in SPAN_NAME_METRICS:
+        if span_name.startswith(prefix):
+            return name, (('kind', span_name[len(prefix):]),)
+    return span_name, ()
@@ -0,0 +1,53 @@
+"""
+Per-query span overhead of the db.Connection instrumentation pattern:
+child span, name/kind/endpoint, annotation with repr of arguments
+(computed lazily by the aioapp variant).
+
+    python examples/bench_tracing.py
+"""
+import timeit
+import aiozipkin as az
+import aiozipkin.tracer as azt
+from aioapp.tracer import Tracer, NOOP_TRACER, annotate_lazy
+
+
+ARGS = (12345, 'some string argument', [1, 2, 3])
+NUMBER = 100000
+
+
+class NullTransport:
+    def send(self, record):
+        pass
+
+
+def query_span(context_span, lazy):
+    span = context_span.tracer.new_child(context_span.context)
+    with span:
+        span.kind(az.CLIENT)
+        span.name("db:%s" % 'query_id')
+        span.remote_endpoint("postgres")
+        if lazy:
+            annotate_lazy(span, repr, ARGS)
+        else:
+            span.annotate(repr(ARGS))
+
+
+def main():
+    endpoint = az.create_endpoint('bench')
+    sampler = az.Sampler(sample_rate=1.0)
+    stock = azt.Tracer(NullTransport(), sampler, endpoint)
+    tracer = Tracer(NullTransport(), sampler, endpoint)
+    cases = [
+        ('sampled span', stock.new_trace(sampled=True), False),
+        ('unsampled, stock tracer', stock.new_trace(sampled=False), False),
+        ('unsampled, aioapp tracer', tracer.new_trace(sampled=False), True),
+        ('no tracer (NOOP_TRACER)', NOOP_TRACER.new_trace(), True),
+    ]
+    for title, context_span, lazy in cases:
+        sec = timeit.timeit(lambda: query_span(context_span, lazy),
+                            number=NUMBER)
+        print('%-26s %8.3f us/query' % (title, sec / NUMBER * 1e6))
+
+
+if __name__ == '__main__':
+    main()
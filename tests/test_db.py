@@ -1,17 +1,26 @@
+import os
+import json
+import time
+import asyncio
+import decimal
+import asyncpg.exceptions
 from typing import Tuple
+from collections import namedtuple
 from aioapp.app import Application
-from aioapp.db import PgDb
-from aioapp.error import PrepareError
+from aioapp.db import (PgDb, ResultCache, JsonTypeCodec, PoolSizer,
+                       PoolBudget, HashRing, LookupRouter, ShardedPgDb)
+from aioapp.error import PrepareError, DeadlineExceededError
+from aioapp import deadline
 import aiozipkin.span as azs
 import pytest
 
 
 async def _start_postgres(app: Application, postgres: Tuple[str, int],
                           connect_max_attempts=10,
-                          connect_retry_delay=1.0) -> PgDb:
+                          connect_retry_delay=1.0, **kwargs) -> PgDb:
     dsn = 'postgres://postgres@%s:%d/postgres' % (postgres[0], postgres[1])
     db = PgDb(dsn, connect_max_attempts=connect_max_attempts,
-              connect_retry_delay=connect_retry_delay)
+              connect_retry_delay=connect_retry_delay, **kwargs)
     app.add('db', db)
     await app.run_prepare()
     await db.start()
@@ -88,3 +97,451 @@ async def test_prepare_failure(app, unused_tcp_port):
         await _start_postgres(app, ('127.0.0.1', unused_tcp_port),
                               connect_max_attempts=2,
                               connect_retry_delay=0.001)
+
+
+async def test_pgdb_warmup(app, postgres):
+    db = await _start_postgres(app, postgres, warmup_connections=2,
+                               warmup_queries=['SELECT $1::int as a'])
+    span = _create_span(app)
+    res = await db.query_one(span, 'test', 'SELECT $1::int as a', 1)
+    assert res['a'] == 1
+    metrics = {(r['name'], r['tags'].get('component')): r
+               for r in app._metrics.collect()}
+    assert ('warmup_ms', 'db') in metrics
+
+
+async def test_pgdb_statement_cache(app, postgres):
+    db = await _start_postgres(app, postgres, statement_cache_size=1)
+    db.register_query('registered', 'SELECT 1')
+    span = _create_span(app)
+
+    for i in range(3):
+        res = await db.query_one(span, 'cached', 'SELECT $1::int as a', i)
+        assert res['a'] == i
+    res = await db.execute(span, 'cached_exec', 'SELECT $1::int', 1)
+    assert res == 'SELECT 1'
+
+    metrics = {(r['name'], r['tags'].get('id')): r['value']
+               for r in app._metrics.collect() if r['kind'] == 'counter'}
+    assert metrics[('db_stmt_cache_hits', 'cached')] >= 1
+    assert metrics[('db_stmt_cache_misses', 'cached_exec')] == 1
+
+    async with db.connection(span) as conn:
+        for i in range(3):
+            await conn.query_one(span, 'evicted%d' % i, 'SELECT %d' % i)
+        res = await conn.query_one(
+            span, 'count', 'SELECT count(*) FROM pg_prepared_statements')
+    # evicted statements are closed by asyncpg before the next prepare
+    assert res[0] <= 2
+
+
+async def test_pgdb_copy_records(app, postgres):
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+    await db.execute(span, 'test', 'CREATE TABLE test_copy(id int, v text)')
+
+    res = await db.copy_records(span, 'copy', 'test_copy',
+                                [(1, 'a'), (2, 'b')], ['id', 'v'])
+    assert res == 'COPY 2'
+
+    async def records():
+        for i in range(25):
+            yield (i, str(i))
+
+    rows = await db.copy_records_stream(span, 'copy_stream', 'test_copy',
+                                        records(), ['id', 'v'],
+                                        batch_size=10)
+    assert rows == 25
+
+    res = await db.query_one(span, 'test', 'SELECT COUNT(*) FROM test_copy')
+    assert res[0] == 27
+
+
+async def test_pgdb_batch(app, postgres):
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+    await db.execute(span, 'test', 'CREATE TABLE test_batch(id int)')
+
+    await db.execute_many(span, 'insert', 'INSERT INTO test_batch VALUES($1)',
+                          [(1,), (2,), (3,)])
+    res = await db.fetch_many(span, 'select',
+                              'SELECT id FROM test_batch WHERE id >= $1',
+                              [(1,), (3,), (4,)])
+    assert [len(r) for r in res] == [3, 1, 0]
+
+
+async def test_pgdb_query_iter(app, postgres):
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+
+    rows = []
+    async for row in db.query_iter(span, 'iter',
+                                   'SELECT generate_series(1, $1::int) as a',
+                                   25, prefetch=10):
+        rows.append(row['a'])
+    assert rows == list(range(1, 26))
+
+    async with db.connection(span) as conn:
+        async with conn.xact(span):
+            rows = [row['a'] async for row in conn.query_iter(
+                span, 'iter', 'SELECT generate_series(1, 3) as a')]
+    assert rows == [1, 2, 3]
+
+    # consumer stops early and is slow, neither is the query's fault
+    it = db.query_iter(span, 'iter_stop',
+                       'SELECT generate_series(1, 25) as a', prefetch=10)
+    async for row in it:
+        await asyncio.sleep(.2, loop=app.loop)
+        break
+    await it.aclose()
+    stats = db.query_stats()['queries']['iter_stop']
+    assert stats['count'] == 1
+    assert stats['errors'] == 0
+    assert stats['sum_ms'] < 200
+
+
+async def test_pgdb_replicas(app, postgres):
+    dsn = 'postgres://postgres@%s:%d/postgres' % (postgres[0], postgres[1])
+    db = await _start_postgres(app, postgres, replica_dsns=[dsn, dsn])
+    span = _create_span(app)
+    assert all(not replica.excluded for replica in db._replicas)
+
+    res = await db.query_one(span, 'test', 'SELECT $1::int as a', 1)
+    assert res['a'] == 1
+    res = await db.query_all(span, 'test', 'SELECT $1::int as a', 1,
+                             use_replica=False)
+    assert res[0]['a'] == 1
+    assert all(replica.in_flight == 0 for replica in db._replicas)
+
+    db._replicas[0].excluded = True
+    assert db._choose_replica() is db._replicas[1]
+    db._replicas[1].excluded = True
+    assert db._choose_replica() is None
+    res = await db.query_one(span, 'test', 'SELECT $1::int as a', 2)
+    assert res['a'] == 2
+
+
+def test_result_cache():
+    cache = ResultCache(10000)
+    cache.set('a', [1, 2], 10, ('t1', 't2'))
+    cache.set('b', None, 10, ('t2',))
+    assert cache.get('a') == (True, [1, 2])
+    assert cache.get('b') == (True, None)
+    assert cache.invalidate(['t2']) == 2
+    assert cache.get('a') == (False, None)
+    assert cache.size == 0
+
+    cache.set('expired', 1, -1, ())
+    assert cache.get('expired') == (False, None)
+
+    cache.set('x', 'x' * 6000, 10, ())
+    cache.set('y', 'y' * 6000, 10, ())
+    assert cache.get('x') == (False, None)
+    assert len(cache) == 1
+
+    # invalidated while the result was being read
+    generation = cache.generation(('t1',))
+    cache.invalidate(['t1'])
+    cache.set('c', 1, 10, ('t1',), generation)
+    assert cache.get('c') == (False, None)
+    generation = cache.generation(('t1',))
+    cache.clear()
+    cache.set('c', 1, 10, ('t1',), generation)
+    assert cache.get('c') == (False, None)
+    cache.set('c', 1, 10, ('t1',), cache.generation(('t1',)))
+    assert cache.get('c') == (True, 1)
+
+    # replica reads shortly after invalidation
+    cache = ResultCache(10000)
+    cache.generation(('t1',))
+    cache.invalidate(['t1', 't2'])
+    assert cache.invalidated_within(('t1', 't3'), 10)
+    assert not cache.invalidated_within(('t1',), -1)
+    assert not cache.invalidated_within(('t2', 't3'), 10)
+    cache.clear()
+    assert cache.invalidated_within(('t3',), 10)
+
+
+async def test_pgdb_result_cache(app, postgres):
+    db = await _start_postgres(app, postgres, result_cache_max_size=100000)
+    db.cache_query('cached', ttl=60, tags=['test_rc'])
+    span = _create_span(app)
+    await db.execute(span, 'test', 'CREATE TABLE test_rc(id int)')
+
+    query = 'SELECT COUNT(*) FROM test_rc WHERE id > $1'
+    assert (await db.query_one(span, 'cached', query, 0))[0] == 0
+    await db.execute(span, 'insert', 'INSERT INTO test_rc VALUES($1)', 1)
+    assert (await db.query_one(span, 'cached', query, 0))[0] == 0
+    await db.execute(span, 'insert', 'INSERT INTO test_rc VALUES($1)', 2,
+                     invalidate=['test_rc'])
+    assert (await db.query_one(span, 'cached', query, 0))[0] == 2
+
+    db.cache_query('cached_all', ttl=60, tags=['test_rc'])
+    query = 'SELECT id FROM test_rc ORDER BY id'
+    res = await db.query_all(span, 'cached_all', query)
+    res.append(None)
+    res = await db.query_all(span, 'cached_all', query)
+    assert [r['id'] for r in res] == [1, 2]
+    assert res is not await db.query_all(span, 'cached_all', query)
+
+
+def test_json_type_codec():
+    codec = JsonTypeCodec()
+    data = codec.encode_jsonb({'a': [1]})
+    assert bytes(data[:1]) == b'\x01'
+    assert codec.decode_jsonb(data) == {'a': [1]}
+    assert codec.decode_json(codec.encode_json({'a': 1})) == {'a': 1}
+    assert codec.encode_json(b'{}') == b'{}'
+    for value in ({1, 2}, object(), decimal.Decimal('1.5')):
+        with pytest.raises(TypeError):
+            codec.encode_jsonb({'a': value})
+
+    raw = JsonTypeCodec(raw=True)
+    assert bytes(raw.decode_jsonb(b'\x01{"a":1}')) == b'{"a":1}'
+    assert raw.decode_json(b'[1]') == b'[1]'
+
+
+async def test_pgdb_raw_json(app, postgres):
+    db = await _start_postgres(app, postgres,
+                               json_codec=JsonTypeCodec(raw=True))
+    span = _create_span(app)
+    res = await db.query_one(span, 'test', 'SELECT $1::jsonb, $2::json',
+                             b'{"a": 1}', {'b': 2})
+    assert json.loads(bytes(res[0]).decode('UTF-8')) == {'a': 1}
+    assert json.loads(bytes(res[1]).decode('UTF-8')) == {'b': 2}
+
+
+async def test_pgdb_pool_metrics(app, postgres):
+    db = await _start_postgres(app, postgres, pool_min_size=2,
+                               pool_max_size=2)
+    span = _create_span(app)
+    async with db.connection(span) as conn:
+        await conn.query_one(span, 'test', 'SELECT 1')
+        metrics = {(r['name'], r['tags'].get('pool')): r
+                   for r in app._metrics.collect()}
+        assert metrics[('db_pool_in_use', 'primary')]['value'] == 1
+        assert metrics[('db_pool_size', 'primary')]['value'] == 2
+        assert metrics[('db_pool_idle', 'primary')]['value'] == 1
+
+    metrics = {(r['name'], r['tags'].get('pool')): r
+               for r in app._metrics.collect()}
+    assert metrics[('db_pool_in_use', 'primary')]['value'] == 0
+    assert metrics[('db_pool_waiters', 'primary')]['value'] == 0
+    assert metrics[('db_pool_acquire_ms', 'primary')]['count'] == 1
+
+
+async def test_pgdb_nested_xact(app, postgres):
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+    await db.execute(span, 'test', 'CREATE TABLE test_nested(id int)')
+
+    async with db.connection(span) as conn:
+        async with conn.xact(span):
+            pass
+        assert not conn._conn.is_in_transaction()
+
+        async with conn.xact(span) as xact:
+            await conn.execute(span, 'insert',
+                               'INSERT INTO test_nested VALUES($1)', 1)
+            try:
+                async with conn.xact(span):
+                    await conn.execute(span, 'insert',
+                                       'INSERT INTO test_nested VALUES(2)')
+                    raise UserWarning()
+            except UserWarning:
+                pass
+            async with conn.xact(span):
+                await conn.execute(span, 'insert',
+                                   'INSERT INTO test_nested VALUES($1)', 3)
+        assert xact.statements == 3
+
+    res = await db.query_all(span, 'test',
+                             'SELECT id FROM test_nested ORDER BY id')
+    assert [r['id'] for r in res] == [1, 3]
+
+
+async def test_pgdb_query_stats(app, postgres):
+    db = await _start_postgres(app, postgres, slow_query_threshold=50.,
+                               slow_query_explain_rate=1.)
+    span = _create_span(app)
+    await db.query_one(span, 'fast', 'SELECT $1::int', 1)
+    await db.query_one(span, 'slow', 'SELECT pg_sleep(0.1), $1::int', 2)
+    try:
+        await db.query_one(span, 'broken', 'SELECT 1/0')
+    except asyncpg.exceptions.DivisionByZeroError:
+        pass
+    await db.execute(span, 'slow_write', 'SELECT pg_sleep(0.1)')
+    async with db.connection(span) as conn:
+        async with conn.xact(span):
+            await conn.execute(span, 'create',
+                               'CREATE TEMP TABLE test_explain (id int)')
+            res = await conn.query_one(span, 'slow_xact',
+                                       'SELECT pg_sleep(0.1), $1::int', 3)
+            assert res[1] == 3
+            await conn.execute(span, 'insert',
+                               'INSERT INTO test_explain VALUES (1)')
+
+    stats = db.query_stats()
+    assert stats['queries']['fast']['count'] == 1
+    assert stats['queries']['fast']['errors'] == 0
+    assert stats['queries']['broken']['errors'] == 1
+    assert stats['queries']['slow']['p50_ms'] >= 50
+    slow = {s['id']: s for s in stats['slow']}
+    assert sorted(slow) == ['slow', 'slow_write', 'slow_xact']
+    assert slow['slow']['args'] == '(2,)'
+    assert 'actual time' in slow['slow']['plan']
+    assert 'actual time' in slow['slow_xact']['plan']
+    assert 'plan' not in slow['slow_write']
+
+
+async def test_pgdb_deadline(app, postgres):
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+    with deadline.scope(span, .1):
+        with pytest.raises(asyncio.TimeoutError):
+            await db.query_one(span, 'sleep', 'SELECT pg_sleep(1)')
+    with deadline.scope(span, deadline=time.time() - 1):
+        with pytest.raises(DeadlineExceededError):
+            await db.query_one(span, 'test', 'SELECT 1')
+
+
+async def test_pool_sizer(loop):
+    sizer = PoolSizer(loop, 2, 8, 10., 2)
+    await sizer.acquire()
+    await sizer.acquire()
+    waiter = asyncio.ensure_future(sizer.acquire(), loop=loop)
+    await asyncio.sleep(0, loop=loop)
+    assert not waiter.done()
+
+    limit, reason = sizer.decide()
+    assert limit == 3
+    sizer.resize(limit)
+    await waiter
+    assert sizer.in_use == 3
+
+    for _ in range(3):
+        sizer.release()
+    assert sizer.decide() == (3, '')
+    assert sizer.decide() == (3, '')
+    assert sizer.decide()[0] == 2
+
+
+def test_pool_budget(tmpdir):
+    budget = PoolBudget(str(tmpdir.join('budget')), 10)
+    pid = os.getpid()
+    assert budget.reserve('%d:a' % pid, 6) == 6
+    assert budget.reserve('%d:b' % pid, 6) == 4
+    assert budget.reserve('%d:a' % pid, 2) == 2
+    budget.release('%d:b' % pid)
+    assert budget.reserve('%d:c' % pid, 10) == 8
+
+
+async def test_pgdb_adaptive_pool(app, postgres):
+    db = await _start_postgres(app, postgres, pool_min_size=1,
+                               pool_max_size=4, pool_adaptive=True,
+                               pool_resize_interval=.1)
+    span = _create_span(app)
+    assert db._pool_sizer.limit == 1
+    await asyncio.gather(*[db.query_one(span, 'sleep', 'SELECT pg_sleep(.2)')
+                           for _ in range(4)], loop=app.loop)
+    assert db._pool_sizer.limit > 1
+
+    # idle connections above a shrunk limit are closed
+    db._pool_sizer.resize(1)
+    assert db._close_idle_connections(1) >= 1
+    assert sum(1 for holder in db.pool._holders
+               if holder._con is not None) == 1
+    res = await db.query_one(span, 'test', 'SELECT 1 AS a')
+    assert res['a'] == 1
+
+
+async def test_pgdb_listen(app, postgres):
+    db = await _start_postgres(app, postgres, result_cache_max_size=100000)
+    span = _create_span(app)
+    calls = []
+    done = asyncio.Future(loop=app.loop)
+
+    def callback(channel, payloads):
+        calls.append((channel, payloads))
+        done.set_result(None)
+
+    sub = await db.listen('test_channel', callback, debounce=.1)
+    for i in range(3):
+        await db.execute(span, 'notify', "NOTIFY test_channel, '%d'" % i)
+    await asyncio.wait_for(done, 1, loop=app.loop)
+    assert calls == [('test_channel', ['0', '1', '2'])]
+    await db.unlisten(sub)
+
+    db.cache_query('cached', 60., tags=['config'])
+    await db.invalidate_on_notify('config_changed')
+    await db.query_one(span, 'cached', 'SELECT 1')
+    assert len(db._result_cache) == 1
+    await db.execute(span, 'notify', "NOTIFY config_changed, 'config'")
+    await asyncio.sleep(.1, loop=app.loop)
+    assert len(db._result_cache) == 0
+
+
+class UserRow:
+    __slots__ = ('id', 'name')
+
+
+async def test_pgdb_row_class(app, postgres):
+    db = await _start_postgres(app, postgres)
+    span = _create_span(app)
+    query = "SELECT i AS id, 'user' || i AS name " \
+            "FROM generate_series(1, 3) i"
+    Row = namedtuple('Row', 'name id')
+
+    rows = await db.query_all(span, 'users', query, row_class=Row)
+    assert rows == [Row('user1', 1), Row('user2', 2), Row('user3', 3)]
+    row = await db.query_one(span, 'users', query, row_class=UserRow)
+    assert (row.id, row.name) == (1, 'user1')
+    rows = [row async for row in db.query_iter(span, 'users', query,
+                                               row_class=UserRow)]
+    assert [row.id for row in rows] == [1, 2, 3]
+    assert len(db._row_mappers) == 2
+    assert await db.query_one(span, 'none', 'SELECT 1 WHERE false',
+                              row_class=Row) is None
+    with pytest.raises(UserWarning):
+        await db.query_one(span, 'bad', 'SELECT 1 AS id', row_class=Row)
+
+
+def test_hash_ring():
+    ring = HashRing(['a', 'b', 'c'])
+    shards = [ring(key) for key in range(3000)]
+    assert shards == [ring(key) for key in range(3000)]
+    assert all(800 < shards.count(shard) < 1200 for shard in 'abc')
+
+    ring4 = HashRing(['a', 'b', 'c', 'd'])
+    moved = sum(1 for key in range(3000) if ring4(key) != shards[key])
+    assert moved < 1200
+
+
+async def test_sharded_pgdb(app, postgres):
+    dsn = 'postgres://postgres@%s:%d/postgres' % (postgres[0], postgres[1])
+    db = ShardedPgDb({'s1': dsn, 's2': dsn},
+                     router=LookupRouter({'tenant1': 's1'}, default='s2'),
+                     pool_min_size=1, pool_max_size=2)
+    app.add('sharded', db)
+    await app.run_prepare()
+    span = _create_span(app)
+
+    assert db.shard('tenant1') is db.shards['s1']
+    assert db.shard('tenant2') is db.shards['s2']
+    row = await db.query_one(span, 'tenant1', 'test', 'SELECT $1::int AS x',
+                             1)
+    assert row['x'] == 1
+
+    rows = await db.query_all_shards(span, 'test', 'SELECT $1::int AS x', 1)
+    assert [row['x'] for row in rows] == [1, 1]
+    res = await db.query_all_shards(span, 'test', 'SELECT 1 AS x',
+                                    merge=lambda res: sorted(res))
+    assert res == ['s1', 's2']
+
+    # shard queries see the deadline of the request span
+    with deadline.scope(span, .1):
+        with pytest.raises(asyncio.TimeoutError):
+            await db.query_all_shards(span, 'sleep', 'SELECT pg_sleep(1)')
+    with deadline.scope(span, deadline=time.time() - 1):
+        with pytest.raises(DeadlineExceededError):
+            await db.execute_all_shards(span, 'test', 'SELECT 1')
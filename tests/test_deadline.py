@@ -0,0 +1,52 @@
+import time
+import pytest
+from aioapp import deadline
+from aioapp.error import DeadlineExceededError
+
+
+def _create_span(app):
+    return app._tracer.new_trace(sampled=False, debug=False)
+
+
+async def test_deadline_scope(app):
+    span = _create_span(app)
+    assert deadline.get(span) is None
+    assert deadline.limit_timeout(span, 5.) == 5.
+
+    with deadline.scope(span, 10.):
+        assert 9. < deadline.time_left(span) <= 10.
+        assert deadline.limit_timeout(span, 5.) == 5.
+        assert deadline.limit_timeout(span, None) <= 10.
+        with deadline.scope(span, 20.):
+            # nested scope can not extend the deadline
+            assert deadline.time_left(span) <= 10.
+        with deadline.scope(span, 1.):
+            assert deadline.time_left(span) <= 1.
+        assert deadline.time_left(span) > 1.
+    assert deadline.get(span) is None
+
+
+async def test_deadline_same_trace_id(app):
+    # concurrent requests may share trace id (it comes from the client)
+    span1 = _create_span(app)
+    span2 = app._tracer.join_span(span1.context)
+    with deadline.scope(span1, 10.):
+        with deadline.scope(span2, 1.):
+            assert deadline.time_left(span1) > 1.
+        assert deadline.get(span2) is None
+        assert deadline.time_left(span1) > 1.
+
+
+async def test_deadline_exceeded(app):
+    span = _create_span(app)
+    with deadline.scope(span, deadline=time.time() - 1):
+        with pytest.raises(DeadlineExceededError):
+            deadline.time_left(span)
+        with pytest.raises(DeadlineExceededError):
+            deadline.limit_timeout(span, 1.)
+
+
+def test_deadline_no_span():
+    with deadline.scope(None, 1.) as value:
+        assert value > time.time()
+    assert deadline.get(None) is None
@@ -0,0 +1,78 @@
+import os
+import socket
+import gzip
+import json
+from aiohttp import web
+from aiohttp.test_utils import make_mocked_request
+from aioapp.http import (Compression, JsonCodec, inherited_fds, _as_socket,
+                         cache_compressed)
+
+
+def test_compression_choose_encoding():
+    comp = Compression(encodings=('gzip', 'deflate'))
+    assert comp.choose_encoding('') is None
+    assert comp.choose_encoding('identity') is None
+    assert comp.choose_encoding('gzip, deflate') == 'gzip'
+    assert comp.choose_encoding('gzip;q=0.5, deflate') == 'deflate'
+    assert comp.choose_encoding('gzip;q=0') is None
+    assert comp.choose_encoding('*') == 'gzip'
+
+
+async def test_compression(loop):
+    comp = Compression(min_size=10, executor_min_size=100,
+                       encodings=('gzip',))
+    req = make_mocked_request('GET', '/',
+                              headers={'Accept-Encoding': 'gzip'})
+
+    small = web.Response(body=b'small')
+    assert (await comp.compress(loop, req, small)).body == b'small'
+
+    body = b'x' * 1000
+    resp = await comp.compress(loop, req, web.Response(body=body))
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(resp.body) == body
+
+    # only marked responses are cached
+    resp2 = await comp.compress(loop, req, web.Response(body=body))
+    assert resp2.body is not resp.body
+    assert len(comp._cache) == 0
+
+    resp = await comp.compress(loop, req,
+                               cache_compressed(web.Response(body=body)))
+    resp2 = await comp.compress(loop, req,
+                                cache_compressed(web.Response(body=b'x' *
+                                                              1000)))
+    assert resp2.body is resp.body
+    assert len(comp._cache) == 1
+
+
+async def test_json_codec_encode():
+    codec = JsonCodec(status=201)
+    req = make_mocked_request('GET', '/')
+    resp = await codec.encode(None, req, {'a': [1, 2]})
+    assert resp.status == 201
+    assert resp.content_type == 'application/json'
+    assert json.loads(resp.body.decode('UTF-8')) == {'a': [1, 2]}
+
+
+def test_inherited_fds():
+    assert inherited_fds({}) == []
+    assert inherited_fds({'AIOAPP_LISTEN_FDS': '5,7'}) == [5, 7]
+    assert inherited_fds({'LISTEN_FDS': '2'}) == [3, 4]
+    assert inherited_fds({'LISTEN_FDS': '2',
+                          'LISTEN_PID': str(os.getpid())}) == [3, 4]
+    assert inherited_fds({'LISTEN_FDS': '2',
+                          'LISTEN_PID': str(os.getpid() + 1)}) == []
+
+
+def test_as_socket():
+    for family in (socket.AF_INET6, socket.AF_UNIX):
+        orig = socket.socket(family, socket.SOCK_STREAM)
+        fd = os.dup(orig.fileno())
+        orig.close()
+        sock = _as_socket(fd)
+        try:
+            assert sock.family == family
+            assert sock.type == socket.SOCK_STREAM
+        finally:
+            sock.close()
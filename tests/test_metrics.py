@@ -0,0 +1,122 @@
+import pytest
+from aioapp.app import Application
+from aioapp.metrics import Registry, Histogram, Summary
+from aioapp.tracer import stats_metric_name, TracerTransport
+
+
+class StatsdStub:
+    def __init__(self):
+        self.sent = []
+
+    def send_counter(self, name, value, rate=1.0):
+        self.sent.append(('c', name, value))
+
+    def send_gauge(self, name, value, rate=1.0):
+        self.sent.append(('g', name, value))
+
+    def send_timer(self, name, value, rate=1.0):
+        self.sent.append(('ms', name, value))
+
+
+def test_histogram():
+    hist = Histogram('lat', (), bounds=(10, 100))
+    for val in (1, 10, 50, 1000):
+        hist.observe(val)
+    assert hist.count == 4
+    assert hist.sum == 1061
+    assert hist.buckets() == [('10', 2), ('100', 3), ('inf', 4)]
+    assert hist.quantile(0.5) == 10
+    assert hist.quantile(0.75) == 100
+    assert hist.quantile(1) == float('inf')
+
+
+def test_registry():
+    reg = Registry()
+    assert reg.counter('a', {'x': 1}) is reg.counter('a', {'x': '1'})
+    assert reg.counter('a', {'x': 1}) is not reg.counter('a', {'x': 2})
+    with pytest.raises(UserWarning):
+        reg.gauge('a', {'x': 1})
+
+    reg.counter('a').inc(2)
+    reg.gauge('g').set(5)
+    reg.histogram('h', bounds=(1,)).observe(0.5)
+    recs = {r['name'] + str(r['tags']): r for r in reg.collect()}
+    assert recs['a{}']['value'] == 2
+    assert recs['g{}']['value'] == 5
+    assert recs['h{}']['buckets'] == [('1', 1), ('inf', 1)]
+
+
+def test_registry_send_to_statsd():
+    reg = Registry()
+    stub = StatsdStub()
+    reg.counter('c', {'k': 'v'}).inc(3)
+    reg.gauge('g').set(1)
+    reg.send_to_statsd(stub, 'p_', stats_metric_name)
+    assert ('c', 'p_c,k=v', 3) in stub.sent
+    assert ('g', 'p_g', 1) in stub.sent
+
+    stub.sent = []
+    reg.counter('c', {'k': 'v'}).inc(1)
+    reg.send_to_statsd(stub, 'p_', stats_metric_name)
+    assert stub.sent == [('c', 'p_c,k=v', 1), ('g', 'p_g', 1)]
+
+
+def test_summary():
+    summary = Summary(max_samples=100)
+    for val in range(1, 1001):
+        summary.observe(val)
+    assert summary.count == 1000
+    assert summary.sum == 500500
+    assert (summary.min, summary.max) == (1, 1000)
+    assert len(summary.samples) == 100
+    assert summary.percentiles([100])[0] <= 1000
+
+    summary = Summary()
+    for val in (1, 2, 3, 4):
+        summary.observe(val)
+    assert summary.percentiles([0, 50, 75, 100]) == [1, 2, 3, 4]
+
+
+async def test_tracer_transport_aggregate(loop):
+    app = Application(loop=loop)
+    transport = TracerTransport(app, None, None, None, None, 'p_', 1, loop,
+                                metrics_aggregate=True,
+                                metrics_percentiles=(50,))
+    transport.stats = StatsdStub()
+    recs = [{'name': 'db:select', 'tags': {}, 'duration': d * 1000}
+            for d in (1, 2, 3, 4)]
+    await transport._send_to_statsd(recs)
+    assert transport.stats.sent == [
+        ('c', 'p_db_count,kind=select', 4),
+        ('c', 'p_db_sum,kind=select', 10),
+        ('g', 'p_db_min,kind=select', 1),
+        ('g', 'p_db_max,kind=select', 4),
+        ('g', 'p_db_p50,kind=select', 2),
+    ]
+    transport.stats = None
+    await transport.close()
+
+
+async def test_tracer_transport_metric_names(loop):
+    app = Application(loop=loop)
+    transport = TracerTransport(app, None, None, None, None, 'p_', 1, loop,
+                                metrics_name_cache_size=2)
+    transport.stats = StatsdStub()
+    recs = [
+        {'name': 'GET /', 'kind': 'SERVER', 'duration': 2000,
+         'tags': {'http.path': '/', 'http.status_code': '200',
+                  'http.method': 'GET'}},
+        {'name': 'db:select', 'tags': {}, 'duration': 1000},
+        {'name': 'db:select', 'tags': {}, 'duration': 3000},
+        {'name': 'custom name', 'tags': {}, 'duration': 1000},
+    ]
+    await transport._send_to_statsd(recs)
+    assert transport.stats.sent == [
+        ('ms', 'p_http,kind=in,status=200,method=GET', 2),
+        ('ms', 'p_db,kind=select', 1),
+        ('ms', 'p_db,kind=select', 3),
+        ('ms', 'p_custom_name', 1),
+    ]
+    assert len(transport._metrics_names) == 2
+    transport.stats = None
+    await transport.close()
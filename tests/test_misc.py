@@ -6,8 +6,9 @@ import asyncio
 from functools import partial
 import pytest
 from yarl import URL
+import aioapp.misc
 from aioapp.misc import (async_call, get_func_params, mask_url_pwd,
-                         json_encode, rndstr, parse_dsn)
+                         json_encode, json_dumps_bytes, rndstr, parse_dsn)
 
 
 async def test_async_call(loop):
@@ -204,6 +205,21 @@ def test_json_encode():
     assert json_encode(given) == json.dumps(expected)
 
 
+@pytest.mark.parametrize('data', [
+    {1: 'a', 'b': [1, 2.5, None, True]},
+    {'big': 2 ** 70, 'neg': -2 ** 64},
+    {'url': URL('http://localhost/'), 'dec': decimal.Decimal('1.5'),
+     'd': datetime.date(2018, 1, 2), 'b': b'abc'},
+])
+def test_json_dumps_bytes_backends(monkeypatch, data):
+    pytest.importorskip('orjson')
+    with_orjson = json_dumps_bytes(data)
+    monkeypatch.setattr(aioapp.misc, 'orjson', None)
+    with_json = json_dumps_bytes(data)
+    assert json.loads(with_orjson.decode('UTF-8')) == \
+        json.loads(with_json.decode('UTF-8'))
+
+
 def test_rndstr():
     rnd = rndstr(6)
     assert isinstance(rnd, str)
@@ -0,0 +1,208 @@
+import aiozipkin as az
+from aioapp.app import Application
+from aioapp.tracer import (NOOP_TRACER, Tracer, TracerTransport, TailSampler,
+                           annotate_lazy, trace_sampled)
+
+
+async def test_noop_tracer(loop):
+    app = Application(loop=loop)
+    assert app.tracer is NOOP_TRACER
+
+    span1 = app.tracer.new_trace(sampled=True)
+    span2 = app.tracer.new_trace()
+    assert span1.is_noop
+    assert span1.context.trace_id != span2.context.trace_id
+
+    child = span1.tracer.new_child(span1.context)
+    assert child.is_noop
+    assert child.context.trace_id == span1.context.trace_id
+    with child:
+        assert child.tag('a', 'b') is child
+        assert child.annotate('x') is child
+
+
+async def test_unsampled_child(app):
+    span = app.tracer.new_trace(sampled=False)
+    child = span.tracer.new_child(span.context)
+    assert child.is_noop
+    assert child.context is span.context
+
+    span = app.tracer.new_trace(sampled=True)
+    child = span.tracer.new_child(span.context)
+    assert not child.is_noop
+    assert child.context.parent_id == span.context.span_id
+
+
+class RecordStub:
+    def __init__(self, name, debug=False, tags=None):
+        self.data = {'name': name, 'debug': debug, 'tags': tags or {},
+                     'annotations': [], 'duration': 1000}
+
+    def asdict(self):
+        return dict(self.data)
+
+
+async def test_transport_queue_limit(loop):
+    app = Application(loop=loop)
+    transport = TracerTransport(app, 'zipkin', 'http://localhost:1', None,
+                                None, None, 1, loop, max_queue_spans=3,
+                                drop_policy='unsampled_first')
+    transport.send(RecordStub('a', debug=True))
+    transport.send(RecordStub('b'))
+    transport.send(RecordStub('c', tags={'error': 'true'}))
+    transport.send(RecordStub('d'))
+    transport.send(RecordStub('e'))
+    assert [d['name'] for d in transport._queue] == ['e']
+    assert [d['name'] for d in transport._queue_kept] == ['a', 'c']
+    assert app._metrics.counter('tracer_spans_dropped',
+                                {'reason': 'spans'}).value == 2
+
+    transport._max_queue_spans = 10
+    transport._max_queue_bytes = 1
+    transport.send(RecordStub('f'))
+    assert len(transport._queue) == 0
+    assert len(transport._queue_kept) == 0
+    assert transport._queue_bytes == 0
+    assert app._metrics.counter('tracer_spans_dropped',
+                                {'reason': 'bytes'}).value == 4
+    transport._driver = None
+    await transport.close()
+
+
+async def test_transport_send_backoff(loop):
+    app = Application(loop=loop)
+    transport = TracerTransport(app, 'zipkin', 'http://localhost:1', None,
+                                None, None, 1, loop, max_queue_spans=2,
+                                drop_policy='newest', max_send_backoff=3)
+    sent = []
+
+    async def post_spans(data):
+        sent.append(data)
+        raise RuntimeError('zipkin is down')
+
+    transport._post_spans = post_spans
+    transport.send(RecordStub('a'))
+    await transport._send()
+    assert transport._send_backoff == 1
+    transport.send(RecordStub('b'))
+    transport.send(RecordStub('c'))
+    assert [d['name'] for d in transport._queue] == ['a', 'b']
+
+    # still backing off
+    await transport._send()
+    assert len(sent) == 1
+
+    for backoff in (2, 3, 3):
+        transport._send_retry_at = 0
+        await transport._send()
+        assert transport._send_backoff == backoff
+    assert [d['name'] for d in sent[-1]] == ['a', 'b']
+    assert app._metrics.counter('tracer_send_errors').value == 4
+
+    async def post_spans_ok(data):
+        sent.append(data)
+
+    transport._post_spans = post_spans_ok
+    transport._send_retry_at = 0
+    await transport._send()
+    assert transport._send_backoff == 0
+    assert len(transport._queue) == 0
+    await transport.close()
+
+
+def span_data(trace_id, name, duration=1000, tags=None):
+    return {'traceId': trace_id, 'name': name, 'duration': duration,
+            'tags': tags or {}, 'annotations': []}
+
+
+async def test_tail_sampler(loop):
+    app = Application(loop=loop)
+    sent = []
+    sampler = TailSampler(app, sent.append, 0., window=1, latency_ms=100,
+                          max_traces=3, max_bytes=1024 * 1024)
+    sampler.add(span_data('ok', 'a'), 0)
+    sampler.add(span_data('err', 'a', tags={'error': 'true'}), 0)
+    sampler.add(span_data('slow', 'a', duration=200000), 0)
+    sampler.add(span_data('ok', 'b'), 0.5)
+    sampler.flush(0.9)
+    assert sent == []
+
+    sampler.flush(1.2)
+    assert [(d['traceId'], d['name']) for d in sent] == [('err', 'a'),
+                                                         ('slow', 'a')]
+    sampler.flush(1.5)
+    assert len(sent) == 2
+    # late span follows the decision
+    sampler.add(span_data('err', 'b'), 2)
+    sampler.add(span_data('ok', 'c'), 2)
+    assert [d['name'] for d in sent] == ['a', 'a', 'b']
+
+    metrics = app._metrics
+    assert metrics.counter('tracer_tail_traces',
+                           {'decision': 'kept', 'reason': 'error'}).value == 1
+    assert metrics.counter('tracer_tail_traces',
+                           {'decision': 'kept', 'reason': 'slow'}).value == 1
+    assert metrics.counter('tracer_tail_traces',
+                           {'decision': 'dropped'}).value == 1
+
+
+async def test_tail_sampler_limits(loop):
+    app = Application(loop=loop)
+    sent = []
+    sampler = TailSampler(app, sent.append, 1., window=1, latency_ms=100,
+                          max_traces=2, max_bytes=1024 * 1024)
+    for trace_id in ('t1', 't2', 't3'):
+        sampler.add(span_data(trace_id, 'a'), 0)
+    assert [d['traceId'] for d in sent] == ['t1']
+    assert app._metrics.counter('tracer_tail_early_decisions').value == 1
+
+    sampler._max_bytes = 1
+    sampler.add(span_data('t4', 'a'), 0)
+    assert [d['traceId'] for d in sent] == ['t1', 't2', 't3', 't4']
+    assert sampler._size == 0
+    assert app._metrics.counter(
+        'tracer_tail_traces', {'decision': 'kept', 'reason': 'rate'}
+    ).value == 4
+
+
+async def test_annotate_lazy(app):
+    calls = []
+
+    def value(x):
+        calls.append(x)
+        return str(x)
+
+    span = app.tracer.new_trace(sampled=False)
+    annotate_lazy(span, value, 1)
+    assert calls == []
+
+    span = app.tracer.new_trace(sampled=True)
+    with span:
+        annotate_lazy(span, value, 2)
+    assert calls == [2]
+
+
+def test_trace_sampled():
+    ids = ['%032x' % (i * 0x9e3779b97f4a7c15 % 2 ** 128)
+           for i in range(1, 1001)]
+    kept = [trace_id for trace_id in ids if trace_sampled(trace_id, .3)]
+    assert 200 < len(kept) < 400
+    assert all(trace_sampled(trace_id, .5) for trace_id in kept)
+    assert not any(trace_sampled(trace_id, 0.) for trace_id in ids)
+    assert all(trace_sampled(trace_id, 1.) for trace_id in ids)
+
+
+def test_tracer_tail_sampling():
+    tracer = Tracer(None, az.Sampler(sample_rate=0.), az.create_endpoint('t'),
+                    tail_sampling=True)
+    span = tracer.new_trace(sampled=False)
+    assert not span.is_noop
+    joined = tracer.join_span(span.context._replace(sampled=False))
+    assert not joined.is_noop
+    assert joined.context.trace_id == span.context.trace_id
+
+    headers = tracer.make_headers(span)
+    assert headers['X-B3-TraceId'] == span.context.trace_id
+    assert 'X-B3-Sampled' not in headers
+    assert NOOP_TRACER.make_headers(NOOP_TRACER.new_trace()) == {
+        'X-B3-Sampled': '0'}